@@ -22,9 +22,9 @@ class BoundingBox:
             tuple(self.bounds[0]), tuple(self.bounds[1]))
 
     def hit(self, ray, interval):
-        low, high = self.bounds
+        low, high = tuple(self.bounds[0]), tuple(self.bounds[1])
         lowt, hight = -inf, inf
-        s, d = ray.start, ray.dir
+        s, d = tuple(ray.start), tuple(ray.dir)
         for axis in range(3):
             if d[axis] == 0:
                 if s[axis] < low[axis] or s[axis] > high[axis]:
@@ -0,0 +1,452 @@
+# bvh.py
+#   Bounding volume hierarchy for fast ray intersection of many primitives.
+#   The tree is built with a binned surface area heuristic (SAH) and
+#   traversed front-to-back so that later subtrees can be culled once a
+#   closer hit has shrunk the ray's interval.
+
+import sys
+import time
+from array import array
+from math import inf
+
+from ren3d.models import Record
+
+
+class BVH:
+    """Binary tree of axis-aligned boxes over a set of primitives.
+
+    items is a sequence of primitives, bounds is a corresponding sequence
+    of (low, high) corner pairs and hit_block(ray, interval, info, block)
+    is a function that intersects ray with a sequence of items (a leaf).
+    It must return True iff there was a hit, recording the closest hit in
+    info and lowering interval.high to its time. hit_any(ray, interval,
+    block), if given, is the matching any-hit test used by occluder: it
+    returns what it found blocking the ray within interval (such as an
+    item of block), or None, recording nothing.
+
+    Nodes are kept in flat arrays (six floats and two ints per node) and
+    the items are reordered so that each leaf is a contiguous slice, so
+    the tree stays small even for millions of primitives. Integer items
+    (e.g. a range of triangle ids) are stored in an int array.
+
+    >>> bounds = [((i, 0, 0), (i+.5, 1, 1)) for i in range(100)]
+    >>> def hit_block(ray, interval, info, block):
+    ...     for i in block:
+    ...         if i <= ray.start.x <= i + .5:
+    ...             info.t, info.item = 4.0, i
+    ...             return True
+    ...     return False
+    >>> bvh = BVH(range(100), bounds, hit_block, leaf_size=4)
+    >>> r = bvh.report()
+    >>> r.prims, r.leaves >= 25, r.max_leaf <= 4
+    (100, True, True)
+    >>> from ren3d.ray3d import Ray, Interval
+    >>> info = Record()
+    >>> bvh.intersect(Ray((20.25, 0.5, 5), (0, 0, -1)), Interval(), info)
+    True
+    >>> info.item
+    20
+    >>> bvh.intersect(Ray((20.75, 0.5, 5), (0, 0, -1)), Interval(), info)
+    False
+    >>> def hit_any(ray, interval, block):
+    ...     for i in block:
+    ...         if i <= ray.start.x <= i + .5:
+    ...             return i
+    >>> bvh.hit_any = hit_any
+    >>> bvh.occluder(Ray((20.25, 0.5, 5), (0, 0, -1)), Interval())
+    20
+    >>> again = BVH.from_arrays(range(100), bvh.boxes, bvh.links, bvh.order,
+    ...                         hit_block, leaf_size=4)
+    >>> again.report().sah_cost == r.sah_cost, list(again.items) == list(bvh.items)
+    (True, True)
+    >>> again.intersect(Ray((20.25, 0.5, 5), (0, 0, -1)), Interval(), info)
+    True
+    """
+
+    TRAVERSE_COST = 1.0
+    INTERSECT_COST = 1.0
+
+    def __init__(self, items, bounds, hit_block, leaf_size=4, buckets=12,
+                 hit_any=None):
+        self.hit_block = hit_block
+        self.hit_any = hit_any
+        self.leaf_size = leaf_size
+        self.buckets = buckets
+        t0 = time.time()
+        # per primitive bounds and centroids, only needed while building
+        lows = [array("d") for a in range(3)]
+        highs = [array("d") for a in range(3)]
+        for low, high in bounds:
+            for a in range(3):
+                lows[a].append(low[a])
+                highs[a].append(high[a])
+        self._lows, self._highs = lows, highs
+        self._cents = [array("d", [(l+h)*.5 for l, h in zip(lows[a], highs[a])])
+                       for a in range(3)]
+        self.nprims = len(lows[0])
+
+        # boxes: lx, ly, lz, hx, hy, hz per node. links: for interior
+        # nodes the left and right child ids, for leaves (-1-start, count)
+        # giving the slice order[start:start+count] of its primitives
+        self.boxes = array("d")
+        self.links = array("i")
+        self.order = array("i")
+        if self.nprims:
+            self._build(array("i", range(self.nprims)))
+        del self._lows, self._highs, self._cents
+
+        self._set_items(items)
+        self.build_time = time.time() - t0
+
+    @classmethod
+    def from_arrays(cls, items, boxes, links, order, hit_block, leaf_size=4,
+                    buckets=12, hit_any=None):
+        """return the BVH over items whose node arrays boxes and links and
+        item order were saved from one built with the same leaf_size and
+        buckets (e.g. in a mesh cache), without building it again
+        """
+        bvh = cls.__new__(cls)
+        bvh.hit_block = hit_block
+        bvh.hit_any = hit_any
+        bvh.leaf_size = leaf_size
+        bvh.buckets = buckets
+        bvh.boxes = array("d", boxes)
+        bvh.links = array("i", links)
+        bvh.order = array("i", order)
+        bvh.nprims = len(bvh.order)
+        bvh._set_items(items)
+        bvh.build_time = 0.0
+        return bvh
+
+    def _set_items(self, items):
+        # items in leaf order, so each leaf is a slice
+        if isinstance(items, (range, array)):
+            self.items = array("i", (items[i] for i in self.order))
+        else:
+            items = list(items)
+            self.items = [items[i] for i in self.order]
+
+    @classmethod
+    def from_objects(cls, objects, **options):
+        """return a BVH over scene objects, each having bbox and intersect"""
+        objects = list(objects)
+        return cls(objects, [obj.bbox.bounds for obj in objects],
+                   _hit_objects, hit_any=_occluding_object, **options)
+
+    # ------------------------------------------------------------------
+    # construction
+
+    def _build(self, prims):
+        # append the node for prims (an array of primitive ids) and its
+        # subtree; returns the node id
+        low, high = self._enclose(prims, self._lows, self._highs)
+        node = len(self.links) // 2
+        self.boxes.extend(low + high)
+        self.links.extend((0, 0))
+        n = len(prims)
+        if n <= self.leaf_size:
+            return self._leaf(node, prims)
+
+        cents = self._cents
+        clow, chigh = self._enclose(prims, cents, cents)
+        axis = max(range(3), key=lambda a: chigh[a] - clow[a])
+        extent = chigh[axis] - clow[axis]
+        if extent <= 0.0:
+            # all centroids coincide, no split can separate them
+            return self._leaf(node, prims)
+
+        split = self._sah_split(prims, axis, clow[axis], extent, low, high)
+        if split is None:
+            return self._leaf(node, prims)
+        c = cents[axis]
+        left = array("i", [p for p in prims if c[p] < split])
+        right = array("i", [p for p in prims if c[p] >= split])
+        if not left or not right:
+            prims = sorted(prims, key=c.__getitem__)
+            left, right = array("i", prims[:n//2]), array("i", prims[n//2:])
+        del prims
+        lnode = self._build(left)
+        del left
+        rnode = self._build(right)
+        self.links[2*node] = lnode
+        self.links[2*node+1] = rnode
+        return node
+
+    def _leaf(self, node, prims):
+        self.links[2*node] = -1 - len(self.order)
+        self.links[2*node+1] = len(prims)
+        self.order.extend(prims)
+        return node
+
+    @staticmethod
+    def _enclose(prims, lows, highs):
+        # (low, high) lists enclosing the given primitives
+        return ([min(map(lows[a].__getitem__, prims)) for a in range(3)],
+                [max(map(highs[a].__getitem__, prims)) for a in range(3)])
+
+    def _sah_split(self, prims, axis, cmin, extent, low, high):
+        # return the centroid coordinate to split at along axis, or None
+        # when making a leaf is cheaper than the best binned split.
+        nb = self.buckets
+        scale = nb / extent
+        counts = [0] * nb
+        blows = [[inf, inf, inf] for i in range(nb)]
+        bhighs = [[-inf, -inf, -inf] for i in range(nb)]
+        lx, ly, lz = self._lows
+        hx, hy, hz = self._highs
+        c = self._cents[axis]
+        for p in prims:
+            b = min(int((c[p] - cmin) * scale), nb - 1)
+            counts[b] += 1
+            _grow(blows[b], bhighs[b], (lx[p], ly[p], lz[p]),
+                  (hx[p], hy[p], hz[p]))
+
+        # sweep from the right accumulating area*count of each suffix
+        right_cost = [0.0] * nb
+        rl, rh, rn = [inf]*3, [-inf]*3, 0
+        for b in range(nb-1, 0, -1):
+            rn += counts[b]
+            _grow(rl, rh, blows[b], bhighs[b])
+            right_cost[b] = _area(rl, rh) * rn
+
+        best, best_b = inf, None
+        ll, lh, ln = [inf]*3, [-inf]*3, 0
+        for b in range(nb-1):
+            ln += counts[b]
+            _grow(ll, lh, blows[b], bhighs[b])
+            if ln == 0 or ln == len(prims):
+                continue
+            cost = _area(ll, lh) * ln + right_cost[b+1]
+            if cost < best:
+                best, best_b = cost, b
+
+        if best_b is None:
+            return None
+        parea = _area(low, high)
+        n = len(prims)
+        cost = self.TRAVERSE_COST
+        if parea > 0:
+            cost += self.INTERSECT_COST * best / parea
+        if n <= 4 * self.leaf_size and cost >= self.INTERSECT_COST * n:
+            return None
+        return cmin + (best_b + 1) / scale
+
+    # ------------------------------------------------------------------
+    # traversal
+
+    def intersect(self, ray, interval, info):
+        """Returns True iff ray hits some item within interval.
+
+        Children are visited nearest first and any subtree whose box is
+        entered after interval.high is skipped.
+        """
+        if not self.nprims:
+            return False
+        sx, sy, sz = ray.start
+        dx, dy, dz = ray.dir
+        ix = 1.0/dx if dx != 0.0 else inf
+        iy = 1.0/dy if dy != 0.0 else inf
+        iz = 1.0/dz if dz != 0.0 else inf
+        boxes, links, items = self.boxes, self.links, self.items
+        hit_block = self.hit_block
+        hit = False
+
+        tnear = _entry(boxes, 0, sx, sy, sz, ix, iy, iz, interval)
+        if tnear is None:
+            return False
+        stack = [(tnear, 0)]
+        pop, push = stack.pop, stack.append
+        while stack:
+            tnear, node = pop()
+            if tnear > interval.high:
+                continue
+            left, right = links[2*node], links[2*node+1]
+            if left < 0:
+                start = -1 - left
+                if hit_block(ray, interval, info, items[start:start+right]):
+                    hit = True
+                continue
+            tl = _entry(boxes, left, sx, sy, sz, ix, iy, iz, interval)
+            tr = _entry(boxes, right, sx, sy, sz, ix, iy, iz, interval)
+            if tl is None:
+                if tr is not None:
+                    push((tr, right))
+            elif tr is None:
+                push((tl, left))
+            elif tl <= tr:
+                push((tr, right))
+                push((tl, left))
+            else:
+                push((tl, left))
+                push((tr, right))
+        return hit
+
+    def occluder(self, ray, interval):
+        """Returns an item hit by ray within interval (as found by
+        hit_any), or None.
+
+        The search stops at the first leaf with a hit, so the item need
+        not be the nearest; interval is left unchanged.
+        """
+        if not self.nprims:
+            return None
+        sx, sy, sz = ray.start
+        dx, dy, dz = ray.dir
+        ix = 1.0/dx if dx != 0.0 else inf
+        iy = 1.0/dy if dy != 0.0 else inf
+        iz = 1.0/dz if dz != 0.0 else inf
+        boxes, links, items = self.boxes, self.links, self.items
+        hit_any = self.hit_any
+        if _entry(boxes, 0, sx, sy, sz, ix, iy, iz, interval) is None:
+            return None
+        stack = [0]
+        pop, push = stack.pop, stack.append
+        while stack:
+            node = pop()
+            left, right = links[2*node], links[2*node+1]
+            if left < 0:
+                start = -1 - left
+                item = hit_any(ray, interval, items[start:start+right])
+                if item is not None:
+                    return item
+                continue
+            if _entry(boxes, right, sx, sy, sz, ix, iy, iz,
+                      interval) is not None:
+                push(right)
+            if _entry(boxes, left, sx, sy, sz, ix, iy, iz,
+                      interval) is not None:
+                push(left)
+        return None
+
+    def translate(self, offset):
+        """move every node box by offset (dx, dy, dz), e.g. after the
+        primitives have all been moved by it
+        """
+        boxes = self.boxes
+        for k in range(len(boxes)):
+            boxes[k] += offset[k % 3]
+
+    # ------------------------------------------------------------------
+    # diagnostics
+
+    def nbytes(self):
+        """memory used by the node and item arrays, in bytes"""
+        total = 0
+        for buf in (self.boxes, self.links, self.items):
+            if isinstance(buf, array):
+                total += buf.itemsize * len(buf)
+            else:
+                total += sys.getsizeof(buf)
+        return total
+
+    def report(self):
+        """Returns a Record describing the shape and build cost of the tree
+
+        Fields: prims, nodes, leaves, depth, min_leaf, max_leaf, mean_leaf,
+        sah_cost (expected cost of a ray query relative to a single
+        intersection test), nbytes and build_time (seconds).
+        """
+        boxes, links = self.boxes, self.links
+        nodes = len(links) // 2
+        leaves = depth = 0
+        sizes = []
+        sah = 0.0
+        if nodes:
+            root_area = _area(boxes[0:3], boxes[3:6]) or 1.0
+            stack = [(0, 1)]
+            while stack:
+                node, d = stack.pop()
+                depth = max(depth, d)
+                b = 6*node
+                frac = _area(boxes[b:b+3], boxes[b+3:b+6]) / root_area
+                left, right = links[2*node], links[2*node+1]
+                if left < 0:
+                    leaves += 1
+                    sizes.append(right)
+                    sah += frac * self.INTERSECT_COST * right
+                else:
+                    sah += frac * self.TRAVERSE_COST
+                    stack.append((left, d+1))
+                    stack.append((right, d+1))
+        return Record(prims=self.nprims, nodes=nodes, leaves=leaves,
+                      depth=depth,
+                      min_leaf=min(sizes, default=0),
+                      max_leaf=max(sizes, default=0),
+                      mean_leaf=round(sum(sizes)/max(leaves, 1), 2),
+                      sah_cost=round(sah, 2),
+                      nbytes=self.nbytes(),
+                      build_time=round(self.build_time, 4))
+
+
+# ----------------------------------------------------------------------
+# helper functions
+
+def _hit_objects(ray, interval, info, block):
+    # leaf intersection for BVH.from_objects (module level so that a
+    # BVH can be pickled, e.g. to send a scene to worker processes)
+    hit = False
+    for obj in block:
+        if obj.intersect(ray, interval, info):
+            interval.high = info.t
+            hit = True
+    return hit
+
+
+def _occluding_object(ray, interval, block):
+    # any-hit leaf test for BVH.from_objects
+    for obj in block:
+        blocker = obj.occluder(ray, interval)
+        if blocker is not None:
+            return blocker
+    return None
+
+
+def _grow(low, high, pl, ph):
+    for a in range(3):
+        if pl[a] < low[a]:
+            low[a] = pl[a]
+        if ph[a] > high[a]:
+            high[a] = ph[a]
+
+
+def _area(low, high):
+    # surface area of a box; 0 for an empty box
+    ex, ey, ez = high[0]-low[0], high[1]-low[1], high[2]-low[2]
+    if ex < 0 or ey < 0 or ez < 0:
+        return 0.0
+    return 2.0 * (ex*ey + ey*ez + ez*ex)
+
+
+def _entry(boxes, node, sx, sy, sz, ix, iy, iz, interval):
+    # slab test of a node's box; returns the entry time or None on a miss
+    t0, t1 = interval.low, interval.high
+    b = 6*node
+    for s, inv, lo, hi in ((sx, ix, boxes[b], boxes[b+3]),
+                           (sy, iy, boxes[b+1], boxes[b+4]),
+                           (sz, iz, boxes[b+2], boxes[b+5])):
+        if inv == inf:
+            if s < lo or s > hi:
+                return None
+            continue
+        ta = (lo - s) * inv
+        tb = (hi - s) * inv
+        if ta > tb:
+            ta, tb = tb, ta
+        if ta > t0:
+            t0 = ta
+        if tb < t1:
+            t1 = tb
+        if t0 > t1:
+            return None
+    return t0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        # python -m ren3d.bvh teapot.off [leaf_size]
+        from ren3d.mesh import Mesh
+        leaf = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+        print(Mesh(sys.argv[1], (0, 1, 0), leaf_size=leaf).bvh.report())
+    else:
+        import doctest
+        doctest.testmod()
@@ -66,7 +66,7 @@ class Camera:
         self.n = (eyept - Point(lookat)).normalized()
         self.u = Vector(up).cross(self.n).normalized()
         self.v = self.n.cross(self.u)
-        self.trans = to_uvn(self.u, self.v, self.n, eye)
+        self.trans = to_uvn(self.u, self.v, self.n, eyept)
         self.eye = eyept
 
     def set_resolution(self, width, height):
@@ -83,9 +83,7 @@ class Camera:
         l, b, r, t = self.window
         x = l + (i+0.5)*self.dx
         y = b + (j+0.5)*self.dy
-        start = Point((0, 0, 0))
-        end = Point((x, y, -self.distance))
-        return Ray(start, end-start)
+        return Ray(Point((0, 0, 0)), Vector((x, y, -self.distance)))
 
 
     
@@ -0,0 +1,193 @@
+# grid.py
+#   Uniform grid for fast ray intersection of many similarly sized objects.
+#   Objects are binned into the cells their bounding boxes overlap and a
+#   ray walks the cells it pierces in order (3D DDA), stopping as soon as
+#   a hit is found that lies inside the cells already visited.
+
+import time
+from math import inf
+
+from ren3d.models import Record
+
+
+class UniformGrid:
+    """Regular 3D grid of cells over a set of bounded objects.
+
+    Each object must have a bbox and an intersect method. density is the
+    target number of cells per object.
+
+    >>> from ren3d.models import Sphere
+    >>> from ren3d.ray3d import Ray, Interval
+    >>> spheres = [Sphere((x, 0, -10), .4) for x in range(-5, 6)]
+    >>> grid = UniformGrid(spheres)
+    >>> info = Record()
+    >>> grid.intersect(Ray((3, 0, 0), (0, 0, -1)), Interval(), info)
+    True
+    >>> round(info.t, 6)
+    9.6
+    >>> grid.intersect(Ray((3.5, 0, 0), (0, 0, -1)), Interval(), info)
+    False
+    >>> grid.report().objects
+    11
+    """
+
+    def __init__(self, objects, density=2.0):
+        t0 = time.time()
+        objects = list(objects)
+        low, high = [inf]*3, [-inf]*3
+        for obj in objects:
+            blow, bhigh = obj.bbox.bounds
+            for a in range(3):
+                low[a] = min(low[a], blow[a])
+                high[a] = max(high[a], bhigh[a])
+        # pad degenerate (flat) axes so every axis has some thickness
+        ext = [high[a] - low[a] for a in range(3)]
+        pad = max(ext) * 1e-3 or 1.0
+        for a in range(3):
+            if ext[a] <= 0.0:
+                low[a] -= pad
+                high[a] += pad
+                ext[a] = 2*pad
+        volume = ext[0]*ext[1]*ext[2]
+        cells_per_unit = (density * len(objects) / volume) ** (1/3)
+        self.res = [max(1, min(128, int(ext[a] * cells_per_unit + .5)))
+                    for a in range(3)]
+        self.low, self.high = low, high
+        self.cellsize = [ext[a] / self.res[a] for a in range(3)]
+
+        nx, ny, nz = self.res
+        cells = [[] for i in range(nx*ny*nz)]
+        for obj in objects:
+            blow, bhigh = obj.bbox.bounds
+            i0, j0, k0 = self._cell(blow)
+            i1, j1, k1 = self._cell(bhigh)
+            for k in range(k0, k1+1):
+                for j in range(j0, j1+1):
+                    for i in range(i0, i1+1):
+                        cells[(k*ny + j)*nx + i].append(obj)
+        self.cells = [tuple(c) if c else None for c in cells]
+        self.nobjects = len(objects)
+        self.build_time = time.time() - t0
+
+    def _cell(self, p):
+        # cell coordinates containing point p (clamped to the grid)
+        return tuple(min(self.res[a]-1,
+                         max(0, int((p[a] - self.low[a]) / self.cellsize[a])))
+                     for a in range(3))
+
+    def intersect(self, ray, interval, info):
+        """Returns True iff ray hits some object within interval.
+
+        Cells are visited in ray order; the walk stops once the closest
+        hit so far lies before the exit of the current cell.
+        """
+        hit = False
+        for objs, texit in self._walk(ray, interval):
+            if objs is not None:
+                for obj in objs:
+                    if obj.intersect(ray, interval, info):
+                        interval.high = info.t
+                        hit = True
+            if hit and interval.high <= texit:
+                return True
+        return hit
+
+    def occluder(self, ray, interval):
+        """Returns the part of an object hit by ray within interval (see
+        Group.occluder), or None; the walk stops at the first one found,
+        which need not be the nearest.
+
+        >>> from ren3d.models import Sphere
+        >>> from ren3d.ray3d import Ray, Interval
+        >>> grid = UniformGrid([Sphere((0, 0, z), .4) for z in (-4, -8)])
+        >>> ray = Ray((0, 0, 0), (0, 0, -1))
+        >>> grid.occluder(ray, Interval()).pos
+        Point([0.0, 0.0, -4.0])
+        >>> grid.occluder(ray, Interval(0, 3)) is None
+        True
+        """
+        for objs, texit in self._walk(ray, interval):
+            if objs is not None:
+                for obj in objs:
+                    blocker = obj.occluder(ray, interval)
+                    if blocker is not None:
+                        return blocker
+        return None
+
+    def _walk(self, ray, interval):
+        # generate (objects or None, exit time) for each cell that ray
+        # passes through within interval, in order (3D DDA)
+        s, d = ray.start, ray.dir
+        low, high = self.low, self.high
+        t0, t1 = interval.low, interval.high
+        for a in range(3):
+            if d[a] == 0.0:
+                if s[a] < low[a] or s[a] > high[a]:
+                    return
+                continue
+            ta = (low[a] - s[a]) / d[a]
+            tb = (high[a] - s[a]) / d[a]
+            if ta > tb:
+                ta, tb = tb, ta
+            t0 = max(t0, ta)
+            t1 = min(t1, tb)
+            if t0 > t1:
+                return
+
+        res, size = self.res, self.cellsize
+        nx, ny = res[0], res[1]
+        cell, step, tnext, tdelta, stop = [], [], [], [], []
+        for a in range(3):
+            p = s[a] + t0*d[a]
+            c = min(res[a]-1, max(0, int((p - low[a]) / size[a])))
+            cell.append(c)
+            if d[a] > 0.0:
+                step.append(1)
+                stop.append(res[a])
+                tnext.append((low[a] + (c+1)*size[a] - s[a]) / d[a])
+                tdelta.append(size[a] / d[a])
+            elif d[a] < 0.0:
+                step.append(-1)
+                stop.append(-1)
+                tnext.append((low[a] + c*size[a] - s[a]) / d[a])
+                tdelta.append(-size[a] / d[a])
+            else:
+                step.append(0)
+                stop.append(None)
+                tnext.append(inf)
+                tdelta.append(inf)
+
+        cells = self.cells
+        i, j, k = cell
+        while True:
+            # advance along the axis whose cell boundary is nearest
+            if tnext[0] < tnext[1]:
+                a = 0 if tnext[0] < tnext[2] else 2
+            else:
+                a = 1 if tnext[1] < tnext[2] else 2
+            texit = tnext[a]
+            yield cells[(k*ny + j)*nx + i], texit
+            if texit > t1:
+                return
+            cell[a] += step[a]
+            if cell[a] == stop[a]:
+                return
+            tnext[a] += tdelta[a]
+            i, j, k = cell
+
+    def report(self):
+        """Returns a Record describing the grid: objects, res (cells per
+        axis), cells, empty cells, refs (object references stored),
+        max_refs (most objects in one cell) and build_time (seconds).
+        """
+        counts = [len(c) for c in self.cells if c is not None]
+        return Record(objects=self.nobjects, res=tuple(self.res),
+                      cells=len(self.cells),
+                      empty=len(self.cells) - len(counts),
+                      refs=sum(counts), max_refs=max(counts, default=0),
+                      build_time=round(self.build_time, 4))
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -4,6 +4,7 @@
 
 
 import array
+import mmap
 
 # needed for img.show()
 from ren3d import ppmview
@@ -38,18 +39,18 @@ class Image:
     >>> img.save("blank.ppm")     # blank.ppm is 640x470 all white
     """
 
-    def __init__(self, fileorsize):
+    def __init__(self, fileorsize, lazy=False):
         """Create an Image from ppm file or create blank Image of given size.
         fileorsize is either a string giving the path to a ppm file or
-        a tuple (width, height)
+        a tuple (width, height); lazy is passed on to load.
         """
 
         if type(fileorsize) == str:
-            self.load(fileorsize)
+            self.load(fileorsize, lazy)
         else:
             width, height = fileorsize
             self.size = (width, height)
-            self.pixels = array.array("B", [0 for i in range(3*width*height)])
+            self.pixels = array.array("B", bytes(3*width*height))
         self.viewer = None
 
     def _base(self, pos):
@@ -69,10 +70,12 @@ class Image:
         rgb is a triple of ints in range(256) representing
             the intensity of red, green, and blue for this pixel.
         """
-        if self._legalpos(pos):
+        x, y = pos
+        w, h = self.size
+        if 0 <= x < w and 0 <= y < h:
             r, g, b = rgb
             pixels = self.pixels
-            base = self._base(pos)
+            base = 3*(w*(h-y-1) + x)
             pixels[base] = r
             pixels[base+1] = g
             pixels[base+2] = b
@@ -86,26 +89,109 @@ class Image:
         base = self._base(pos)
         return tuple(self.pixels[base:base+3])
 
+    def set_row(self, y, data, x=0):
+        """ Set a run of pixels in row y starting at column x.
+        data is a bytes-like object (bytes, bytearray, array of bytes or
+        memoryview) of r, g, b values, 3 per pixel. The part of the run
+        that is off the image is ignored.
+
+        >>> img = Image((4, 2))
+        >>> img.set_row(0, bytes([255, 0, 0]*2), x=1)
+        >>> img[1, 0], img[2, 0], img[3, 0]
+        ((255, 0, 0), (255, 0, 0), (0, 0, 0))
+        """
+        w, h = self.size
+        if not 0 <= y < h:
+            return
+        data = memoryview(data).cast("B")
+        n = len(data) // 3
+        lo, hi = max(x, 0), min(x + n, w)
+        if lo >= hi:
+            return
+        base = 3*(w*(h-y-1))
+        self.view_bytes()[base+3*lo:base+3*hi] = data[3*(lo-x):3*(hi-x)]
+
+    def blit(self, pos, src):
+        """ Copy Image src into this image with its lower-left pixel at
+        pos (x, y), one row at a time. Parts that fall off the image are
+        ignored.
+
+        >>> img, tile = Image((4, 3)), Image((2, 2))
+        >>> tile.clear((9, 9, 9))
+        >>> img.blit((3, 1), tile)
+        >>> [(x, y) for y in range(3) for x in range(4) if img[x, y][0]]
+        [(3, 1), (3, 2)]
+        """
+        x, y = pos
+        sw, sh = src.size
+        rows = src.view_bytes()
+        for j in range(max(0, -y), min(sh, self.size[1] - y)):
+            base = 3*sw*(sh-j-1)
+            self.set_row(y + j, rows[base:base+3*sw], x)
+
+    def view(self):
+        """ Return a writable memoryview of the pixels without copying,
+        shaped (height, width, 3) with the top row first, e.g. for
+        numpy.asarray(img.view()).
+
+        >>> img = Image((3, 2))
+        >>> v = img.view()
+        >>> v.shape
+        (2, 3, 3)
+        >>> v[1, 0, 0] = 255     # bottom row, first pixel, red
+        >>> img[0, 0]
+        (255, 0, 0)
+        """
+        w, h = self.size
+        return self.view_bytes().cast("B", (h, w, 3))
+
+    def view_bytes(self):
+        """ Return a writable flat memoryview of the pixels (r, g, b
+        bytes, top row first) without copying.
+        """
+        return memoryview(self.pixels).cast("B")
+
+    def header(self):
+        """ Get the ppm header for the image as bytes """
+        return "P6\n{0} {1}\n255\n".format(*self.size).encode()
+
     def save(self, fname):
         """ Save image as ppm in file called fname """
         with open(fname, "wb") as ofile:
-            ofile.write(self.getdata())
+            ofile.write(self.header())
+            ofile.write(self.pixels)
 
     def getdata(self):
         """ Get image information as bytes in ppm format
         """ 
-        s = b"P6\n"
-        s += "{0} {1}\n".format(*self.size).encode()
-        s += b"255\n"
-        s += self.pixels.tobytes()
-        return s
+        return b"".join((self.header(), self.pixels))
 
-    def load(self, fname):
+    def load(self, fname, lazy=False):
         """load raw PPM file from fname.
         Note 1: The width and height of the image will be adjusted
                 to match what is found in the file.
 
         Note 2: This is not a general method for all PPM files, but works for most
+
+        With lazy, only the header is read now. The pixels become a
+        read-only view of the file mapped into memory, which the system
+        reads as they are first looked at (and can drop again when
+        memory is short); writing to them raises TypeError.
+
+        >>> import os, tempfile
+        >>> tmp = tempfile.TemporaryDirectory()
+        >>> fname = os.path.join(tmp.name, "dot.ppm")
+        >>> img = Image((3, 2))
+        >>> img[2, 1] = (1, 2, 3)
+        >>> img.save(fname)
+        >>> lazy = Image(fname, lazy=True)
+        >>> lazy.size, lazy[2, 1], lazy.getdata() == img.getdata()
+        ((3, 2), (1, 2, 3), True)
+        >>> lazy[0, 0] = (4, 5, 6)
+        Traceback (most recent call last):
+        ...
+        TypeError: cannot modify read-only memory
+        >>> del lazy; tmp.cleanup()
         """
 
         infile = open(fname, "rb")
@@ -120,6 +206,16 @@ class Image:
 
         infile.readline()  # skip the maxval
 
+        if lazy:
+            start, end = infile.tell(), infile.tell() + width*height*3
+            with infile:
+                mm = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+            if len(mm) < end:
+                raise ValueError("Truncated PPM File: {}".format(fname))
+            self.pixels = memoryview(mm)[start:end]
+            self.size = (width, height)
+            return
+
         # The data should be all that's left in fields
         self.pixels = array.array("B")
         self.pixels.fromfile(infile, width*height*3)
@@ -129,19 +225,53 @@ class Image:
     def clear(self, rgb):
         """ set every pixel in Image to rgb
         rgb is a triple: (R, G, B) where R, G, & B are 0-255.
+
+        The pixels are filled in place by doubling slice copies, so views
+        of them stay valid.
         """
-        r, g, b = rgb
-        pix = self.pixels
-        for i in range(0, len(pix), 3):
-            pix[i] = r
-            pix[i+1] = g
-            pix[i+2] = b
-
-    def show(self):
-        """ display image using ppmview """
-        if not (self.viewer and self.viewer.isalive()):
-            self.viewer = ppmview.PPMViewer("PPM Image")
-        self.viewer.show(self.getdata())
+        pix = self.view_bytes()
+        size = len(pix)
+        if not size:
+            return
+        pix[0:3] = bytes(rgb)
+        n = 3
+        while n < size:
+            k = min(n, size - n)
+            pix[n:n+k] = pix[0:k]
+            n += k
+
+    def show(self, rect=None):
+        """ display image using ppmview
+
+        The pixels are copied into a frame shared with the viewer, which
+        redraws only what changed at its own refresh rate, so calling
+        show after every scanline of a render is cheap. rect (x0, y0, x1,
+        y1) limits the update to columns x0 to x1-1 of rows y0 to y1-1;
+        by default the whole image is updated.
+        """
+        viewer = self.viewer
+        if not (viewer and viewer.isalive() and viewer.size == self.size):
+            self.unshow()
+            viewer = self.viewer = ppmview.PPMViewer("PPM Image", self.size)
+            rect = None
+        w, h = self.size
+        if rect is None:
+            x0, y0, x1, y1 = 0, 0, w, h
+        else:
+            x0, y0, x1, y1 = rect
+            x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, w), min(y1, h)
+            if x0 >= x1 or y0 >= y1:
+                return
+        # the frame has the top row first, like the pixels
+        top, bottom = h - y1, h - y0
+        pix, frame = self.view_bytes(), viewer.frame
+        if x0 == 0 and x1 == w:
+            frame[3*w*top:3*w*bottom] = pix[3*w*top:3*w*bottom]
+        else:
+            for row in range(top, bottom):
+                base = 3*w*row
+                frame[base+3*x0:base+3*x1] = pix[base+3*x0:base+3*x1]
+        viewer.update((x0, top, x1, bottom))
 
     def unshow(self):
         """ close viewing window """
@@ -8,54 +8,82 @@ from math import sqrt
 INF = float("inf")
 EPSILON = 10.0e-12
 
+# Points and Vectors are (x, y, z) objects with __slots__. Arithmetic
+# builds results with _point and _vector, which skip the float() coercion
+# done by the public constructors. A 2D Point or Vector leaves z unset;
+# operations on one (or with a plain sequence as operand) fall back to
+# working on the coordinate sequences (see _coords), as they always have.
+_new = object.__new__
+
+
+def _point(x, y, z):
+    p = _new(Point)
+    p.x = x
+    p.y = y
+    p.z = z
+    return p
+
+
+def _vector(x, y, z):
+    v = _new(Vector)
+    v.x = x
+    v.y = y
+    v.z = z
+    return v
+
+
+def _coords(v):
+    # tuple of the coordinates of a Point or Vector (2 or 3 of them) or
+    # of any other sequence
+    if type(v) is Point or type(v) is Vector:
+        try:
+            return (v.x, v.y, v.z)
+        except AttributeError:
+            return (v.x, v.y)
+    return tuple(v)
+
+
+def _set_coords(v, coords):
+    # initialize Point or Vector v from 2 or 3 coordinates
+    x, y, *z = coords
+    v.x = float(x)
+    v.y = float(y)
+    if z:
+        z, = z
+        v.z = float(z)
+
+
 class Point:
     """A location in 2- or 3-space
 
     """
 
+    __slots__ = ("x", "y", "z")
+
     def __init__(self, coords):
         """ A point in 2- or 3-space
         >>> p2 = Point([1,2])
         >>> p3 = Point([1,2,3])
         """
-        self._coords = [float(v) for v in coords]
+        _set_coords(self, coords)
 
     def __repr__(self):
-        """ 
+        """
         >>> Point([1,2,3])
         Point([1.0, 2.0, 3.0])
+        >>> Point([1,2])
+        Point([1.0, 2.0])
         """
-        return "Point(" + str(self._coords) + ")"
-
-    @property
-    def x(self):
-        return self._coords[0]
-
-    @x.setter
-    def x(self, v):
-        self._coords[0] = float(v)
-
-    @property
-    def y(self):
-        return self._coords[1]
-
-    @y.setter
-    def y(self, v):
-        self._coords[1] = float(v)
-
-    @property
-    def z(self):
-        return self._coords[2]
-
-    @z.setter
-    def z(self, v):
-        self._coords[2] = float(v)
+        return "Point({!r})".format(list(_coords(self)))
 
     def __getitem__(self, i):
-        return self._coords[i]
+        try:
+            return (self.x, self.y, self.z)[i]
+        except AttributeError:
+            return (self.x, self.y)[i]
 
     def __setitem__(self, i, value):
-        self._coords[i] = float(value)
+        setattr(self, "xyz"[i], float(value))
 
     def __iter__(self):
         """ Point is a sequence of its coordinates
@@ -71,74 +99,106 @@ class Point:
         >>> x, y, z = p
         >>> x, y, z
         (1.0, 2.0, 3.0)
+        >>> list(Point([1,2]))
+        [1.0, 2.0]
         """
-        return iter(self._coords)
+        try:
+            return iter((self.x, self.y, self.z))
+        except AttributeError:
+            return iter((self.x, self.y))
 
     def __sub__(self, other):
         """ Difference of Point with another Point or a Vector
 
         A point minus a point produces a vector.
         A point minus a vector produces a point.
-        
+
        >>> Point([1,2,3]) - Point([5,-3,2])
        Vector([-4.0, 5.0, 1.0])
         >>> Point([1,2,3]) - Vector([5,-3,2])
         Point([-4.0, 5.0, 1.0])
-        >>> 
+        >>> Point([1,2]) - Point([5,-3])
+        Vector([-4.0, 5.0])
+
+        """
+        try:
+            make = _vector if type(other) is Point else _point
+            return make(self.x-other.x, self.y-other.y, self.z-other.z)
+        except AttributeError:
+            restype = Vector if type(other) is Point else Point
+            return restype([a-b for a, b in zip(_coords(self),
+                                                _coords(other))])
+
+    def __add__(self, other):
+        """ Point plus a Vector produces a Point
+
+        >>> Point([1,2,3]) + Vector([4,5,6])
+        Point([5.0, 7.0, 9.0])
+        >>> Point([1,2,3]) + (1, 1, 1)
+        Point([2.0, 3.0, 4.0])
+        """
+        try:
+            return _point(self.x+other.x, self.y+other.y, self.z+other.z)
+        except AttributeError:
+            return Point([a+b for a, b in zip(_coords(self),
+                                              _coords(other))])
+
+    def madd(self, s, v):
+        """ returns the Point self + s*v without an intermediate Vector
+
+        >>> Point([1,2,3]).madd(2, Vector([1,0,-1]))
+        Point([3.0, 2.0, 1.0])
+        """
+        return _point(self.x+s*v.x, self.y+s*v.y, self.z+s*v.z)
+
+    def sub_dot(self, other, v):
+        """ returns (self - other).dot(v) without an intermediate Vector
+
+        >>> Point([1,2,3]).sub_dot(Point([0,1,2]), Vector([1,2,3]))
+        6.0
+        """
+        return ((self.x-other.x)*v.x + (self.y-other.y)*v.y
+                + (self.z-other.z)*v.z)
+
+    def dist2(self, other):
+        """ Square of the distance to other
 
+        >>> Point([1,2,3]).dist2(Point([2,4,6]))
+        14.0
         """
-        restype = Vector if type(other) == Point else Point
-        return restype([a-b for a, b in zip(self, other)])
+        dx, dy, dz = self.x-other.x, self.y-other.y, self.z-other.z
+        return dx*dx + dy*dy + dz*dz
 
 
 class Vector:
     """A vector in 2- or 3-space
     """
 
+    __slots__ = ("x", "y", "z")
+
     def __init__(self, coords):
         """
         >>> v1 = Vector([1, 2, 3])
         >>> v2 = Vector([4.3, 5.2])
         """
-        self._coords = [float(v) for v in coords]
+        _set_coords(self, coords)
 
     def __repr__(self):
         """
         >>> Vector([1,2,3])
         Vector([1.0, 2.0, 3.0])
         """
-        return "Vector(" + str(self._coords) + ")"
-
-    @property
-    def x(self):
-        return self._coords[0]
-
-    @x.setter
-    def x(self, v):
-        self._coords[0] = float(v)
-
-    @property
-    def y(self):
-        return self._coords[1]
-
-    @y.setter
-    def y(self, v):
-        self._coords[1] = float(v)
-
-    @property
-    def z(self):
-        return self._coords[2]
-
-    @z.setter
-    def z(self, v):
-        self._coords[2] = float(v)
+        return "Vector({!r})".format(list(_coords(self)))
 
     def __iter__(self):
         """
         >>> list(Vector([1,2,3]))
         [1.0, 2.0, 3.0]
         """
-        return iter(self._coords)
+        try:
+            return iter((self.x, self.y, self.z))
+        except AttributeError:
+            return iter((self.x, self.y))
 
     def __getitem__(self, i):
         """
@@ -147,12 +207,15 @@ class Vector:
         1.0
         >>> v[2]
         5.0
-        
+
         """
-        return self._coords[i]
+        try:
+            return (self.x, self.y, self.z)[i]
+        except AttributeError:
+            return (self.x, self.y)[i]
 
     def __setitem__(self, i, v):
-        """ set ith item 
+        """ set ith item
 
         >>> v = Vector((1, 3, 5))
         >>> v[1] = 4
@@ -161,7 +224,7 @@ class Vector:
 
         """
 
-        self._coords[i] = float(v)
+        setattr(self, "xyz"[i], float(v))
 
     def __rmul__(self, s):
         """ multiplication by a preceeding scalar
@@ -169,15 +232,23 @@ class Vector:
         >>> 3 * Vector([1,2,3])
         Vector([3.0, 6.0, 9.0])
         """
-        return Vector(s*v for v in self)
+        try:
+            return _vector(s*self.x, s*self.y, s*self.z)
+        except AttributeError:
+            return Vector([s*a for a in _coords(self)])
 
     def __mul__(self, s):
         """ multiplication by a succeeding scalar
         >>> Vector([1,2,3]) * 3
         Vector([3.0, 6.0, 9.0])
+        >>> Vector([1,2]) * 3
+        Vector([3.0, 6.0])
         """
-        return Vector(s*v for v in self)
-    
+        try:
+            return _vector(s*self.x, s*self.y, s*self.z)
+        except AttributeError:
+            return Vector([s*a for a in _coords(self)])
+
     def __add__(self, other):
         """ vector addition with other on right
         the result type depends on other: vector + point --> point
@@ -187,40 +258,66 @@ class Vector:
         Point([4.0, 1.0, 5.0])
         >>> Vector([3, -1, 2]) + Vector([1, 2, 3])
         Vector([4.0, 1.0, 5.0])
+
+        Any other sequence gives a result of its own type
+        >>> Vector([3, -1, 2]) + (1, 2, 3)
+        (4.0, 1.0, 5.0)
         """
-        res_type = type(other)
-        return res_type(a+b for a, b in zip(self, other))
+        try:
+            make = _point if type(other) is Point else _vector
+            return make(self.x+other.x, self.y+other.y, self.z+other.z)
+        except AttributeError:
+            return _generic_add(self, other)
 
     def __radd__(self, other):
         """ vector addition with other on left (see __add__)
 
         >>> Point([1,2,3]) + Vector([4,5,6])
         Point([5.0, 7.0, 9.0])
+        >>> (1, 2, 3) + Vector([4,5,6])
+        (5.0, 7.0, 9.0)
         """
-        res_type = type(other)
-        return res_type(a+b for a, b in zip(self, other))
+        try:
+            make = _point if type(other) is Point else _vector
+            return make(other.x+self.x, other.y+self.y, other.z+self.z)
+        except AttributeError:
+            return _generic_add(self, other)
 
     def __neg__(self):
         """negation
         >>> -Vector([1,-2,3])
         Vector([-1.0, 2.0, -3.0])
         """
-        return Vector(-a for a in self)
+        try:
+            return _vector(-self.x, -self.y, -self.z)
+        except AttributeError:
+            return Vector([-a for a in _coords(self)])
 
     def __sub__(self, other):
         """vector subtraction
         >>> Vector([1,2,3]) - Vector([-3,1,2.5])
         Vector([4.0, 1.0, 0.5])
+        >>> Vector([1,2,3]) - (1, 1, 1)
+        Vector([0.0, 1.0, 2.0])
         """
-        return Vector(a-b for a,b in zip(self, other))
+        try:
+            return _vector(self.x-other.x, self.y-other.y, self.z-other.z)
+        except AttributeError:
+            return Vector([a-b for a, b in zip(_coords(self),
+                                               _coords(other))])
 
     def dot(self, other):
         """ Vector dot product
 
         >>> Vector([1,2,3]).dot(Vector([2,3,4]))
         20.0
+        >>> Vector([1,2]).dot(Vector([2,3]))
+        8.0
         """
-        return sum(a*b for a,b in zip(self,other))
+        try:
+            return self.x*other.x + self.y*other.y + self.z*other.z
+        except AttributeError:
+            return sum(a*b for a, b in zip(_coords(self), _coords(other)))
 
     def cross(self, other):
         """ Vector cross product
@@ -228,9 +325,17 @@ class Vector:
         >>> Vector([1,2,3]).cross(Vector([4,5,6]))
         Vector([-3.0, 6.0, -3.0])
         """
-        ax, ay, az = self._coords
-        bx, by, bz = other._coords
-        return Vector((ay*bz-by*az, az*bx-ax*bz, ax*by-ay*bx))
+        ax, ay, az = self.x, self.y, self.z
+        bx, by, bz = other.x, other.y, other.z
+        return _vector(ay*bz-by*az, az*bx-ax*bz, ax*by-ay*bx)
+
+    def madd(self, s, other):
+        """ returns the Vector self + s*other without an intermediate
+
+        >>> Vector([1,2,3]).madd(2, Vector([1,0,-1]))
+        Vector([3.0, 2.0, 1.0])
+        """
+        return _vector(self.x+s*other.x, self.y+s*other.y, self.z+s*other.z)
 
     def mag2(self):
         """ Square of magnitude
@@ -238,14 +343,18 @@ class Vector:
         >>> Vector([1,2,3]).mag2()
         14.0
         """
-        return self.dot(self)
+        try:
+            x, y, z = self.x, self.y, self.z
+            return x*x + y*y + z*z
+        except AttributeError:
+            return sum(a*a for a in _coords(self))
 
     def mag(self):
         """ Magnitude
         >>> Vector([1,2,3]).mag()
         3.7416573867739413
         """
-        return sqrt(self.dot(self))
+        return sqrt(self.mag2())
 
     def normalize(self):
         """ make this vector unit length
@@ -256,8 +365,12 @@ class Vector:
         Vector([0.2672612419124244, 0.5345224838248488, 0.8017837257372732])
         """
         m = self.mag()
-        for i in range(len(self._coords)):
-            self._coords[i] /= m
+        self.x /= m
+        self.y /= m
+        try:
+            self.z /= m
+        except AttributeError:
+            pass
 
     def normalized(self):
         """ return normalized version of this vector
@@ -267,9 +380,34 @@ class Vector:
         >>> v
         Vector([1.0, 2.0, 3.0])
         """
-        return 1/self.mag() * self
-    
+        try:
+            x, y, z = self.x, self.y, self.z
+        except AttributeError:
+            return self * (1/self.mag())
+        s = 1/sqrt(x*x + y*y + z*z)
+        return _vector(s*x, s*y, s*z)
+
+
+def unit(x, y, z):
+    """ (x, y, z) scaled to unit length, as a tuple; a zero vector is
+    returned as (0.0, 0.0, 0.0). For inner loops that work on coordinates
+    rather than Vectors.
+
+    >>> unit(3, 0, 4)
+    (0.6, 0.0, 0.8)
+    >>> unit(0, 0, 0)
+    (0.0, 0.0, 0.0)
+    """
+    m = sqrt(x*x + y*y + z*z)
+    if m == 0.0:
+        return 0.0, 0.0, 0.0
+    return x/m, y/m, z/m
+
 
+def _generic_add(v, other):
+    # sum of Vector v and a Point, Vector or other sequence, of the type
+    # of other
+    return type(other)(a+b for a, b in zip(_coords(v), _coords(other)))
 
 
 if __name__ == "__main__":
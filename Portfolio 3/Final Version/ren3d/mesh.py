@@ -3,23 +3,40 @@
 #    tools for handling meshes from OFF files.
 #    The main "export" is Mesh
 
-from ren3d.math3d import Point, Vector
+from array import array
+from math import cos, inf, radians
+
+from ren3d.math3d import Point, Vector, EPSILON, unit
 from ren3d.bbox import BoundingBox
+from ren3d.bvh import BVH
+from ren3d import meshcache
 from ren3d.materials import make_material
-from ren3d.models import Group, Record
+from ren3d.models import Record
 
 
 class Triangle:
-    """Model for a triangle """
+    """Model for a triangle
+
+    The first vertex p0, the edge vectors e1 = p1 - p0 and e2 = p2 - p0
+    and the geometric normal are computed once, here, for the
+    Moller-Trumbore intersection test.
+    """
 
     def __init__(self, points, color=(0, 1, 0), normals=[]):
         
         self.points = list(points)
         self.color = color
+        p0, p1, p2 = self.points
+        self.p0 = p0
+        self.e1 = p1 - p0
+        self.e2 = p2 - p0
+        self.normal = Vector(unit(*self.e1.cross(self.e2)))
         if normals:
             self.normals = normals
         else:
-            self.normals= [self._make_normals(self.points)]*3
+            self.normals = [self.normal]*3
+        n0, n1, n2 = self.normals
+        self._flat = n0 is n1 is n2
 
         self.bbox = BoundingBox()
         self.bbox.include_points(self.points)
@@ -34,15 +51,63 @@ class Triangle:
                      normals = self.normals)
 
     def intersect(self, ray, interval, info):
-        if not self.bbox.hit(ray,interval):
+        """ Moller-Trumbore ray/triangle test
+
+        >>> from ren3d.ray3d import Ray, Interval
+        >>> tri = Triangle([Point((0,0,0)), Point((1,0,0)), Point((0,1,0))])
+        >>> info = Record()
+        >>> tri.intersect(Ray((.25, .25, 2), (0, 0, -1)), Interval(), info)
+        True
+        >>> info.t, info.normal
+        (2.0, Vector([0.0, 0.0, 1.0]))
+        >>> tri.intersect(Ray((.75, .75, 2), (0, 0, -1)), Interval(), info)
+        False
+        """
+        hit = self._hit(ray, interval)
+        if hit is None:
             return False
+        t, u, v = hit
+        self._setinfo(ray, t, info, self._normal_at(u, v))
+        return True
 
+    def occluder(self, ray, interval):
+        """ returns the triangle if ray hits it within interval, else
+        None (see Group.occluder)
+        """
+        return None if self._hit(ray, interval) is None else self
 
-    def _make_normals(self,points):
-        U = points[1] - points[0]
-        V = points[2] - points[0]
-        
-        return U.cross(V).normalized()  
+    def _hit(self, ray, interval):
+        # (t, u, v) where ray meets the triangle within interval, or None
+        dx, dy, dz = ray.dir
+        e1x, e1y, e1z = self.e1
+        e2x, e2y, e2z = self.e2
+        px, py, pz = dy*e2z-dz*e2y, dz*e2x-dx*e2z, dx*e2y-dy*e2x
+        det = e1x*px + e1y*py + e1z*pz
+        if -EPSILON < det < EPSILON:
+            return None   # ray parallel to the triangle
+        inv = 1.0/det
+        tx, ty, tz = ray.start - self.p0
+        u = (tx*px + ty*py + tz*pz)*inv
+        if u < 0.0 or u > 1.0:
+            return None
+        qx, qy, qz = ty*e1z-tz*e1y, tz*e1x-tx*e1z, tx*e1y-ty*e1x
+        v = (dx*qx + dy*qy + dz*qz)*inv
+        if v < 0.0 or u + v > 1.0:
+            return None
+        t = (e2x*qx + e2y*qy + e2z*qz)*inv
+        if t not in interval:
+            return None
+        return t, u, v
+
+    def _normal_at(self, u, v):
+        # shading normal at barycentric coordinates (u, v)
+        n0, n1, n2 = self.normals
+        if self._flat:
+            return n0
+        w = 1.0 - u - v
+        return Vector(unit(w*n0.x + u*n1.x + v*n2.x,
+                            w*n0.y + u*n1.y + v*n2.y,
+                            w*n0.z + u*n1.z + v*n2.z))
 
     def _setinfo(self,ray,t,info,normal):
         info.t = t
@@ -56,120 +121,545 @@ class Triangle:
 class Mesh:
     """model to implement polygonal mesh from OFF file
 
-    Mesh is modeled as a group of triangles with a bounding box.
+    The mesh is stored in shared arrays rather than as one Triangle
+    object per face: vertex coordinates xs, ys, zs, a triangle index
+    buffer tris (three vertex ids per triangle) and normals nxs, nys, nzs
+    indexed by nids (three per triangle, one for each corner). Triangles
+    are addressed by integer id and a bounding volume hierarchy over the
+    ids (see ren3d.bvh) gives fast intersection. The edge vectors used by
+    the intersection test are kept in e1x, e1y, e1z, e2x, e2y, e2z.
     """
 
-    def __init__(self, fname, color, recenter=False, smooth=False):
-        meshdata = OFFData(fname)
+    def __init__(self, fname, color, recenter=False, smooth=False,
+                 leaf_size=4, crease=None):
+        data = OFFData(fname, crease)
+        self.color = make_material(color)
+        self.smooth = smooth
+        verts = data.verts
+        self.xs, self.ys, self.zs = [array("d", verts[a::3])
+                                     for a in range(3)]
+
+        # the triangles, their edges and the hierarchy are kept in the
+        # mesh cache (for the coordinates as loaded) after the first load
+        cached = data.triangles(leaf_size)
+        if cached is None:
+            tris, corners, faces = _triangulate(data)
+            self.tris = tris
+            self._make_edges()
+            self.bvh = BVH(range(self.ntris), self._tri_bounds(),
+                           self._hit_triangles, leaf_size=leaf_size,
+                           hit_any=self._occluding_triangle)
+            bvh = self.bvh
+            data.store_triangles(leaf_size, tris=tris, corners=corners,
+                                 faces=faces, edges=self._edges(),
+                                 boxes=bvh.boxes, links=bvh.links,
+                                 order=bvh.order)
+        else:
+            tris, corners, faces = [array("i", a) for a in
+                                    (cached.tris, cached.corners,
+                                     cached.faces)]
+            self.tris = tris
+            n, edges = len(faces), cached.edges
+            (self.e1x, self.e1y, self.e1z,
+             self.e2x, self.e2y, self.e2z) = [array("d", edges[k:k+n])
+                                              for k in range(0, 6*n, n)]
+            self.bvh = BVH.from_arrays(range(self.ntris), cached.boxes,
+                                       cached.links, cached.order,
+                                       self._hit_triangles,
+                                       leaf_size=leaf_size,
+                                       hit_any=self._occluding_triangle)
+
+        if not smooth:
+            normals = data.face_norms
+            nids = array("i")
+            for f in faces:
+                nids.extend((f, f, f))
+        elif crease is None:
+            normals = data.vert_norms
+            nids = tris
+        else:
+            # a normal for every corner of every face
+            cos_crease = cos(radians(crease))
+            offsets, indices = data.offsets, data.indices
+            normals = array("d")
+            for f in data.face_indexes:
+                for k in range(offsets[f], offsets[f+1]):
+                    normals.extend(data._corner_normal(f, indices[k],
+                                                       cos_crease))
+            nids = corners
+        del corners, faces
+        self.nids = nids
+        self.nxs, self.nys, self.nzs = [array("d", normals[a::3])
+                                        for a in range(3)]
+
         if recenter:
-            meshdata.recenter()
+            # the hierarchy is for the points as loaded; its boxes still
+            # enclose their triangles exactly once both are moved, since
+            # rounding the subtraction preserves order
+            mx, my, mz = data.bbox.midpoint
+            data.recenter()
+            verts = data.verts
+            self.xs, self.ys, self.zs = [array("d", verts[a::3])
+                                         for a in range(3)]
+            self._make_edges()
+            self.bvh.translate((-mx, -my, -mz))
+        self.bbox = data.bbox
+
+    @property
+    def ntris(self):
+        return len(self.tris) // 3
+
+    def tri_points(self, tri):
+        """list of the three Points of triangle tri"""
+        xs, ys, zs = self.xs, self.ys, self.zs
+        return [Point((xs[i], ys[i], zs[i])) for i in self.tris[3*tri:3*tri+3]]
 
-        group = Group()
-        for trl in _make_mesh_triangles(meshdata, color, smooth):
-            group.add(trl)
-        self.group
-        self.group = group
-        self.bbox = meshdata.bbox
+    def tri_normals(self, tri):
+        """tuple of the three corner normals of triangle tri"""
+        nxs, nys, nzs = self.nxs, self.nys, self.nzs
+        return tuple(Vector((nxs[i], nys[i], nzs[i]))
+                     for i in self.nids[3*tri:3*tri+3])
 
     def iter_polygons(self):
-        return self.group.iter_polygons()
+        """generate a Record(points, normals, color, keys, vertex_keys)
+        per triangle
+
+        Triangles sharing a vertex share its Point (and normal) object.
+        keys holds one (mesh, vertex id, normal id) tuple per corner so
+        that per-vertex work such as lighting can be done once, and
+        vertex_keys one (mesh, vertex id) tuple, which is the same for
+        every corner at a vertex whatever its normal (as for edges).
+        """
+        color = self.color
+        xs, ys, zs, tris = self.xs, self.ys, self.zs, self.tris
+        nxs, nys, nzs, nids = self.nxs, self.nys, self.nzs, self.nids
+        points = [None] * len(xs)
+        normals = [None] * len(nxs)
+        for k in range(0, len(tris), 3):
+            vs, ns = tris[k:k+3], nids[k:k+3]
+            for v in vs:
+                if points[v] is None:
+                    points[v] = Point((xs[v], ys[v], zs[v]))
+            for n in ns:
+                if normals[n] is None:
+                    normals[n] = Vector((nxs[n], nys[n], nzs[n]))
+            yield Record(points=[points[v] for v in vs], color=color,
+                         normals=tuple(normals[n] for n in ns),
+                         keys=tuple((self, v, n) for v, n in zip(vs, ns)),
+                         vertex_keys=tuple((self, v) for v in vs))
 
     def intersect(self, ray, interval, info):
-        if not self.bbox.hit(ray, interval):
-            return false
-        return self.group.intersect(ray, interval, info)
-   
-def _make_mesh_triangles(facepoints, facenormals, color):
-    """helper function to turn a face into tiangles
+        # the root of the hierarchy is the mesh bounding box
+        return self.bvh.intersect(ray, interval, info)
 
-    facepoints is list of points and facenormals is a corresponding
-    list of normals. color is a material
+    def occluder(self, ray, interval):
+        """Returns a MeshTriangle that ray hits within interval, or None;
+        the search stops at the first one found (see Group.occluder)
+        """
+        tri = self.bvh.occluder(ray, interval)
+        return None if tri is None else MeshTriangle(self, tri)
 
-    """
-    color = make_material(color)
-    for face in data.face_indexes:
-        points = data.get_points(face)
-        if smooth:
-            normals = data.get_verteces_normals(face)
+    def intersect_triangles(self, ray, interval, info, tris):
+        """Returns True iff ray hits one of the triangles (ids) in tris
+        within interval, recording the closest hit in info as intersect
+        does
+        """
+        return self._hit_triangles(ray, interval, info, tris)
+
+    def _tri_bounds(self):
+        # (low, high) corners of each triangle, in id order
+        xs, ys, zs, tris = self.xs, self.ys, self.zs, self.tris
+        for k in range(0, len(tris), 3):
+            a, b, c = tris[k], tris[k+1], tris[k+2]
+            x, y, z = (xs[a], xs[b], xs[c]), (ys[a], ys[b], ys[c]), \
+                      (zs[a], zs[b], zs[c])
+            yield (min(x), min(y), min(z)), (max(x), max(y), max(z))
+
+    def _make_edges(self):
+        xs, ys, zs, tris = self.xs, self.ys, self.zs, self.tris
+        edges = [array("d") for i in range(6)]
+        for k in range(0, len(tris), 3):
+            a, b, c = tris[k], tris[k+1], tris[k+2]
+            for axis, vs in enumerate((xs, ys, zs)):
+                edges[axis].append(vs[b] - vs[a])
+                edges[axis+3].append(vs[c] - vs[a])
+        (self.e1x, self.e1y, self.e1z,
+         self.e2x, self.e2y, self.e2z) = edges
+
+    def _edges(self):
+        # the six edge arrays one after another, as in the mesh cache
+        edges = array("d")
+        for e in (self.e1x, self.e1y, self.e1z, self.e2x, self.e2y, self.e2z):
+            edges.extend(e)
+        return edges
+
+    def intersect_block(self, ray, interval, block, any_hit=False):
+        """Moller-Trumbore test of ray against each triangle id in block
+
+        This is the batched form of Triangle.intersect, run by the BVH
+        leaves on contiguous slices of triangle ids. Returns (tri, t, u, v)
+        for the closest hit within interval, lowering interval.high to
+        its t, or None when nothing is hit. With any_hit the first hit
+        found is returned at once and interval is left unchanged.
+        """
+        xs, ys, zs, tris = self.xs, self.ys, self.zs, self.tris
+        e1xs, e1ys, e1zs = self.e1x, self.e1y, self.e1z
+        e2xs, e2ys, e2zs = self.e2x, self.e2y, self.e2z
+        sx, sy, sz = ray.start
+        dx, dy, dz = ray.dir
+        closest = None
+        for tri in block:
+            e2x, e2y, e2z = e2xs[tri], e2ys[tri], e2zs[tri]
+            px, py, pz = dy*e2z-dz*e2y, dz*e2x-dx*e2z, dx*e2y-dy*e2x
+            e1x, e1y, e1z = e1xs[tri], e1ys[tri], e1zs[tri]
+            det = e1x*px + e1y*py + e1z*pz
+            if -EPSILON < det < EPSILON:
+                continue   # ray parallel to the triangle
+            inv = 1.0/det
+            a = tris[3*tri]
+            tx, ty, tz = sx-xs[a], sy-ys[a], sz-zs[a]
+            u = (tx*px + ty*py + tz*pz)*inv
+            if u < 0.0 or u > 1.0:
+                continue
+            qx, qy, qz = ty*e1z-tz*e1y, tz*e1x-tx*e1z, tx*e1y-ty*e1x
+            v = (dx*qx + dy*qy + dz*qz)*inv
+            if v < 0.0 or u + v > 1.0:
+                continue
+            t = (e2x*qx + e2y*qy + e2z*qz)*inv
+            if interval.low < t < interval.high:
+                if any_hit:
+                    return tri, t, u, v
+                interval.high = t
+                closest = tri, t, u, v
+        return closest
+
+    def _hit_triangles(self, ray, interval, info, block):
+        # BVH leaf test
+        closest = self.intersect_block(ray, interval, block)
+        if closest is None:
+            return False
+        self._setinfo(ray, info, *closest)
+        return True
+
+    def _occluding_triangle(self, ray, interval, block):
+        # BVH any-hit leaf test
+        hit = self.intersect_block(ray, interval, block, any_hit=True)
+        return None if hit is None else hit[0]
+
+    def _setinfo(self, ray, info, tri, t, u, v):
+        # the shading normal is only interpolated for the accepted hit
+        k = 3*tri
+        i0, i1, i2 = self.nids[k], self.nids[k+1], self.nids[k+2]
+        nxs, nys, nzs = self.nxs, self.nys, self.nzs
+        info.t = t
+        info.point = ray.point_at(t)
+        if i0 == i1 == i2:
+            info.normal = Vector(unit(nxs[i0], nys[i0], nzs[i0]))
         else:
-            normals = [data.get_face.normal(face)]*len(points)
-        for l in range(len(points)-1):
-            tri = Triangle([points[0], points[i], points[i+1]],
-                           color,
-                           (normal[0], normals[i], normals[i+1]))
-            yield tri
-    
+            w = 1.0 - u - v
+            info.normal = Vector(unit(w*nxs[i0] + u*nxs[i1] + v*nxs[i2],
+                                       w*nys[i0] + u*nys[i1] + v*nys[i2],
+                                       w*nzs[i0] + u*nzs[i1] + v*nzs[i2]))
+        info.color = self.color
+        info.uvn = None
+        info.texture = None
+
+    def memory_report(self):
+        """Returns a Record of the bytes held by the mesh buffers:
+        vertices, triangles (index buffers), normals, edges, bvh, total
+        and per_triangle.
+        """
+        vertices = _nbytes(self.xs, self.ys, self.zs)
+        triangles = _nbytes(self.tris)
+        if self.nids is not self.tris:
+            triangles += _nbytes(self.nids)
+        normals = _nbytes(self.nxs, self.nys, self.nzs)
+        edges = _nbytes(self.e1x, self.e1y, self.e1z,
+                        self.e2x, self.e2y, self.e2z)
+        bvh = self.bvh.nbytes()
+        total = vertices + triangles + normals + edges + bvh
+        return Record(vertices=vertices, triangles=triangles,
+                      normals=normals, edges=edges, bvh=bvh, total=total,
+                      per_triangle=round(total / max(self.ntris, 1), 1))
+
+
+class MeshTriangle:
+    """Triangle tri of mesh, as found by Mesh.occluder"""
+
+    __slots__ = ("mesh", "tri")
+
+    def __init__(self, mesh, tri):
+        self.mesh = mesh
+        self.tri = tri
+
+    def occluder(self, ray, interval):
+        """returns self if ray hits the triangle within interval, else None
+        """
+        if self.mesh.intersect_block(ray, interval, (self.tri,),
+                                     any_hit=True) is None:
+            return None
+        return self
+
+
+def _triangulate(data):
+    """helper function to fan the faces of a mesh into triangles
+
+    data is an OFFData. Returns int arrays giving for each triangle its
+    three vertex ids (tris), the positions of its corners in data.indices
+    (corners) and the face it came from (faces).
+
+    """
+    offsets, indices = data.offsets, data.indices
+    tris, corners, faces = array("i"), array("i"), array("i")
+    for f in data.face_indexes:
+        first, last = offsets[f], offsets[f+1] - 1
+        for k in range(first+1, last):
+            tris.extend((indices[first], indices[k], indices[k+1]))
+            corners.extend((first, k, k+1))
+            faces.append(f)
+    return tris, corners, faces
+
 
 class OFFData:
-    """Class for reading OFF files and supplying face information"""
+    """Class for reading OFF files and supplying face information
+
+    The mesh is held in flat arrays: verts has x, y, z for each vertex,
+    the vertex indices of face f are indices[offsets[f]:offsets[f+1]] and
+    face_norms (and vert_norms) have three floats per face (vertex).
+    Points and Vectors are only made when asked for, e.g. by get_points.
+
+    Vertex normals are only computed when first asked for (see
+    get_vertex_normals). crease is an optional angle in degrees: faces
+    meeting at a vertex at a greater angle than this do not share a
+    normal, which keeps hard edges sharp in smooth shading.
 
-    def __init__(self, fname):
-        points, faces = self._readOFF("meshes/"+fname)
-        self.points = points
-        self.faces = faces
-        self.face_indexes = range(len(faces))
+    With cache True, the parsed mesh is kept in a binary file next to the
+    OFF file (see ren3d.meshcache) and later loads are read from there.
+    Vertex normals are added to the cache once they have been computed,
+    and a Mesh adds its triangles and hierarchy (see triangles).
+    """
+
+    def __init__(self, fname, crease=None, cache=True):
+        offname = "meshes/"+fname
+        self.crease = crease
+        self._vert_faces = None
+        self._cache = None     # (offname, key) of a cache to add to
+        self._cached = None    # MeshArrays loaded from it
+        if cache:
+            key = meshcache.digest(offname)
+            arrays = meshcache.load(offname, key)
+            if arrays is None:
+                self._load_text(offname)
+                arrays = meshcache.MeshArrays(
+                    self.verts, self.offsets, self.indices, self.face_norms,
+                    None, self.bbox.bounds)
+                if meshcache.save(offname, key, arrays):
+                    self._cache = offname, key
+            else:
+                self._load_arrays(arrays)
+                self._cache, self._cached = (offname, key), arrays
+        else:
+            self._load_text(offname)
+
+    def _load_text(self, offname):
+        self.verts, self.offsets, self.indices = self._readOFF(offname)
         self.bbox = self._make_bbox()
-        self._f_norms = [self._compute_face_normal(f) for f in faces]
-        self._v_norms = [self._compute_vertex_normal(i)
-                         for i in range(len(self.points))]
+        self.face_norms = self._compute_face_normals()
+        self._v_norms = None
+
+    def _load_arrays(self, arrays):
+        # the arrays are views of the memory-mapped cache file
+        self.verts = arrays.vertices
+        self.offsets = arrays.offsets
+        self.indices = arrays.indices
+        self.bbox = BoundingBox(*arrays.bounds)
+        self.face_norms = arrays.face_normals
+        self._v_norms = arrays.vertex_normals
 
     def _readOFF(self, fname):
-        # Read data from OFF file, return vertices and facelists
+        # Read data from OFF file, return vertex, face offset and face
+        # index arrays. Blank lines, comments and per-face colors are
+        # skipped.
         with open(fname) as infile:
-            heading = infile.readline()
-            if heading[:3] != "OFF":
+            lines = (line.split("#")[0].split() for line in infile)
+            lines = (fields for fields in lines if fields)
+            heading = next(lines, [""])
+            if heading[0][:3] != "OFF":
                 raise ValueError("File does not appear to be an OFF")
-            nVerts, nFaces, nEdges = [int(v) for v in infile.readline().split()]
+            counts = heading[1:] or next(lines)
+            nVerts, nFaces = int(counts[0]), int(counts[1])
 
-            verts = []
+            verts = array("d")
             for i in range(nVerts):
-                line = infile.readline()
-                verts.append(Point(float(s) for s in line.split()[:3]))  # ignore rgb
-                faces = []
+                fields = next(lines)
+                verts.extend(float(s) for s in fields[:3])  # ignore rgb
+            offsets, indices = array("i", [0]), array("i")
             for i in range(nFaces):
-                indexStrings = infile.readline().split()[1:]
-                faces.append(tuple(int(s) for s in indexStrings))
-        return verts, faces
+                fields = next(lines)
+                n = int(fields[0])
+                indices.extend(int(s) for s in fields[1:n+1])
+                offsets.append(len(indices))
+        return verts, offsets, indices
+
+    @property
+    def nverts(self):
+        return len(self.verts) // 3
+
+    @property
+    def nfaces(self):
+        return len(self.offsets) - 1
+
+    @property
+    def face_indexes(self):
+        return range(self.nfaces)
+
+    def face(self, f):
+        """tuple of vertex indices for face f"""
+        return tuple(self.indices[self.offsets[f]:self.offsets[f+1]])
+
+    @property
+    def points(self):
+        """list of the vertices as Points"""
+        return [self.point(i) for i in range(self.nverts)]
+
+    @property
+    def faces(self):
+        """list of tuples of vertex indices, one per face"""
+        return [self.face(f) for f in self.face_indexes]
+
+    def point(self, i):
+        """vertex i as a Point"""
+        return Point(self.verts[3*i:3*i+3])
 
     def _make_bbox(self):
-        box = BoundingBox()
-        box.include_points(self.points)
-        return box
-
-    def _compute_face_normal(self, f):
-        a, b, c = [self.points[i] for i in f[:3]]
-        norm = (b-a).cross(c-a)
-        norm.normalize()
-        return norm
-
-    def _compute_vertex_normal(self, vert_i):
-        n = Vector([0, 0, 0])
-        for face_i, face in enumerate(self.faces):
-            if vert_i in face:
-                n += self._f_norms[face_i]
-        try:
-            n.normalize()
-        except ZeroDivisionError:
-            pass
-        return n
+        v = self.verts
+        return BoundingBox([min(v[a::3], default=inf) for a in range(3)],
+                           [max(v[a::3], default=-inf) for a in range(3)])
+
+    def _compute_face_normals(self):
+        # unit normal of the plane of the first three vertices of each
+        # face; zero for a degenerate face
+        v, offsets, indices = self.verts, self.offsets, self.indices
+        norms = array("d")
+        for f in range(self.nfaces):
+            k = offsets[f]
+            a, b, c = 3*indices[k], 3*indices[k+1], 3*indices[k+2]
+            ax, ay, az = v[a], v[a+1], v[a+2]
+            ux, uy, uz = v[b]-ax, v[b+1]-ay, v[b+2]-az
+            wx, wy, wz = v[c]-ax, v[c+1]-ay, v[c+2]-az
+            norms.extend(unit(uy*wz-wy*uz, uz*wx-ux*wz, ux*wy-uy*wx))
+        return norms
+
+    @property
+    def vert_faces(self):
+        """list giving, for each vertex, the indexes of faces that use it"""
+        if self._vert_faces is None:
+            vert_faces = [[] for i in range(self.nverts)]
+            for face_i in self.face_indexes:
+                for vert_i in set(self.face(face_i)):
+                    vert_faces[vert_i].append(face_i)
+            self._vert_faces = vert_faces
+        return self._vert_faces
+
+    @property
+    def vert_norms(self):
+        """flat array of vertex normals, computed when first used"""
+        if self._v_norms is None:
+            self._v_norms = self._compute_vertex_normals()
+            if self._cache is not None:
+                meshcache.update(*self._cache, vertex_normals=self._v_norms)
+        return self._v_norms
+
+    def triangles(self, leaf_size):
+        """MeshArrays from the cache with the triangles and a hierarchy
+        built with leaf_size (see ren3d.meshcache), for the points as
+        loaded (before recenter); None if they are not there
+        """
+        cached = self._cached
+        if cached is None or cached.leaf_size != leaf_size:
+            return None
+        return cached
+
+    def store_triangles(self, leaf_size, **triangles):
+        """add the triangles and a hierarchy built with leaf_size (the
+        arrays named in meshcache.TRIANGLE_FIELDS) to the cache, if any
+        """
+        if self._cache is not None:
+            meshcache.update(*self._cache, leaf_size=leaf_size, **triangles)
+
+    def _compute_vertex_normals(self):
+        # a vertex normal is the normalized sum of the normals of the faces
+        # using that vertex; accumulated in one pass over the faces
+        nverts = self.nverts
+        xs, ys, zs = [0.0]*nverts, [0.0]*nverts, [0.0]*nverts
+        fn = self.face_norms
+        for face_i in self.face_indexes:
+            k = 3*face_i
+            fx, fy, fz = fn[k], fn[k+1], fn[k+2]
+            for vert_i in set(self.face(face_i)):
+                xs[vert_i] += fx
+                ys[vert_i] += fy
+                zs[vert_i] += fz
+        norms = array("d")
+        for n in zip(xs, ys, zs):
+            norms.extend(unit(*n))
+        return norms
+
+    def _corner_normal(self, face_i, vert_i, cos_crease):
+        # normal at vert_i for face_i, summing only the adjacent faces
+        # whose normals are within the crease angle of face_i's normal
+        fn = self.face_norms
+        k = 3*face_i
+        fx, fy, fz = fn[k], fn[k+1], fn[k+2]
+        x = y = z = 0.0
+        for other in self.vert_faces[vert_i]:
+            k = 3*other
+            ox, oy, oz = fn[k], fn[k+1], fn[k+2]
+            if other == face_i or fx*ox + fy*oy + fz*oz >= cos_crease:
+                x += ox
+                y += oy
+                z += oz
+        return unit(x, y, z)
 
     def get_points(self, face):
         """returns a list of points for face; face is an index"""
-        return [self.points[i] for i in self.faces[face]]
+        return [self.point(i) for i in self.face(face)]
 
     def get_face_normal(self, face):
         """return normal for face; face is an index."""
-        return self._f_norms[face]
+        return Vector(self.face_norms[3*face:3*face+3])
 
     def get_vertex_normals(self, face):
         """return list of normals for a face; face is an index"""
-        return [self._v_norms[i] for i in self.faces[face]]
-       
+        if self.crease is not None:
+            cos_crease = cos(radians(self.crease))
+            return [Vector(self._corner_normal(face, i, cos_crease))
+                    for i in self.face(face)]
+        v_norms = self.vert_norms
+        return [Vector(v_norms[3*i:3*i+3]) for i in self.face(face)]
+
     def recenter(self):
         """move points to put midpoint at (0, 0, 0)"""
-        
-        dist = Vector(self.bbox.midpoint)
-        self.points = [vert-dist for vert in self.points]
+        mx, my, mz = self.bbox.midpoint
+        v = self.verts
+        verts = array("d")
+        for i in range(0, len(v), 3):
+            verts.extend((v[i]-mx, v[i+1]-my, v[i+2]-mz))
+        self.verts = verts
         # rebuild the bounding box
         self.bbox = self._make_bbox()
 
+
+def _nbytes(*buffers):
+    return sum(buf.itemsize * len(buf) for buf in buffers)
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1:
+        # python -m ren3d.mesh teapot.off [smooth]
+        mesh = Mesh(sys.argv[1], (0, 1, 0), smooth=len(sys.argv) > 2)
+        print(mesh.ntris, "triangles:", mesh.memory_report())
+    else:
+        import doctest
+        doctest.testmod()
@@ -0,0 +1,235 @@
+# meshcache.py
+#   Compiled binary cache for meshes read from OFF files.
+#
+#   The first time an OFF file is loaded its vertices, faces and normals
+#   are written next to it (teapot.off -> teapot.off.r3m) as flat arrays.
+#   Later loads memory-map the cache instead of parsing text, so they are
+#   fast and processes loading the same mesh share the pages. The cache
+#   is keyed by a hash of the OFF file's contents and rebuilt whenever the
+#   OFF file changes. Values are stored at full (double) precision, so a
+#   mesh loaded from the cache is the same as one parsed from the text.
+#
+#   Two parts are optional and added (see update) once some use of the
+#   mesh has computed them: the vertex normals (for smooth shading) and
+#   the triangles, i.e. the fan triangulation of the faces with the edge
+#   vectors of each triangle and the flat arrays of a bounding volume
+#   hierarchy over them (see ren3d.bvh) built with a given leaf size.
+#   With these a Mesh is loaded without building anything.
+#
+#   Layout (native little-endian, the float64 parts 8-byte aligned):
+#      header: magic, sha1 of OFF file, nverts, nfaces, nindices,
+#              has vertex normals (0 or 1), ntris, nnodes,
+#              leaf size (0 without triangles)              (56 bytes)
+#      bounds: low xyz, high xyz                        float64 x 6
+#      vertices                                         float64 x 3*nverts
+#      face normals                                     float64 x 3*nfaces
+#      vertex normals (only if present)                 float64 x 3*nverts
+#      then, only with triangles:
+#      edges e1x, e1y, e1z, e2x, e2y, e2z               float64 x 6*ntris
+#      hierarchy node boxes                             float64 x 6*nnodes
+#      face offsets into indices                        int32 x nfaces+1
+#      vertex indices of the faces                      int32 x nindices
+#      then, only with triangles:
+#      vertex ids of the triangles                      int32 x 3*ntris
+#      corner positions in indices of the triangles     int32 x 3*ntris
+#      face of each triangle                            int32 x ntris
+#      hierarchy node links                             int32 x 2*nnodes
+#      hierarchy triangle order                         int32 x ntris
+
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+MAGIC = b"R3DMESH3"
+SUFFIX = ".r3m"
+_HEADER = struct.Struct("<8s20s7i")
+_BOUNDS = struct.Struct("<6d")
+
+# the arrays of the triangles part
+TRIANGLE_FIELDS = ("edges", "boxes", "tris", "corners", "faces", "links",
+                   "order")
+
+
+class MeshArrays:
+    """Flat array form of a polygon mesh, usually a view onto a cache file.
+
+    vertices, face_normals and vertex_normals are float sequences with 3
+    values per item; the vertex indices of face f are
+    indices[offsets[f]:offsets[f+1]]. bounds is (low, high).
+    vertex_normals is None when they were not stored.
+
+    leaf_size is None, and the triangles part (the arrays named in
+    TRIANGLE_FIELDS) missing, unless the triangles were stored: three
+    vertex ids per triangle in tris, with the positions in indices of
+    its corners in corners and its face in faces; edges has the six
+    blocks e1x, e1y, e1z, e2x, e2y, e2z of ntris values each (e1 = p1 -
+    p0 and e2 = p2 - p0); and boxes, links and order are the arrays of a
+    BVH over the triangle ids built with leaf_size.
+    """
+
+    def __init__(self, vertices, offsets, indices, face_normals,
+                 vertex_normals, bounds, leaf_size=None, **triangles):
+        self.vertices = vertices
+        self.offsets = offsets
+        self.indices = indices
+        self.face_normals = face_normals
+        self.vertex_normals = vertex_normals
+        self.bounds = bounds
+        self.leaf_size = leaf_size
+        for name in TRIANGLE_FIELDS:
+            setattr(self, name, triangles.get(name))
+
+    @property
+    def nverts(self):
+        return len(self.vertices) // 3
+
+    @property
+    def nfaces(self):
+        return len(self.offsets) - 1
+
+    def face(self, f):
+        """tuple of vertex indices for face f"""
+        return tuple(self.indices[self.offsets[f]:self.offsets[f+1]])
+
+
+def cache_name(offname):
+    return offname + SUFFIX
+
+
+def digest(offname):
+    """sha1 of the contents of the OFF file offname"""
+    with open(offname, "rb") as infile:
+        return hashlib.sha1(infile.read()).digest()
+
+
+def _layout(nverts, nfaces, nindices, vnorms, ntris=None, nnodes=None):
+    # (name, type code, count) of the arrays following the bounds, in
+    # file order; count is None for an optional part that is absent
+    # (the triangles part when ntris is None)
+    def tri(n):
+        return None if ntris is None else n
+    return [("vertices", "d", 3*nverts),
+            ("face_normals", "d", 3*nfaces),
+            ("vertex_normals", "d", 3*nverts if vnorms else None),
+            ("edges", "d", tri(6*(ntris or 0))),
+            ("boxes", "d", tri(6*(nnodes or 0))),
+            ("offsets", "i", nfaces+1),
+            ("indices", "i", nindices),
+            ("tris", "i", tri(3*(ntris or 0))),
+            ("corners", "i", tri(3*(ntris or 0))),
+            ("faces", "i", ntris),
+            ("links", "i", tri(2*(nnodes or 0))),
+            ("order", "i", ntris)]
+
+
+def load(offname, key):
+    """returns MeshArrays mapped from the cache for offname, or None if
+    there is no cache or it was made from different contents (key)
+    """
+    if sys.byteorder != "little":
+        return None
+    try:
+        with open(cache_name(offname), "rb") as infile:
+            mm = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    view = memoryview(mm)
+    if len(view) < _HEADER.size + _BOUNDS.size:
+        return None
+    (magic, stored, nverts, nfaces, nindices, has_vnorms, ntris, nnodes,
+     leaf_size) = _HEADER.unpack_from(view)
+    if magic != MAGIC or stored != key:
+        return None
+
+    pos = _HEADER.size
+    bounds = _BOUNDS.unpack_from(view, pos)
+    pos += _BOUNDS.size
+    if not leaf_size:
+        ntris = nnodes = None
+    layout = _layout(nverts, nfaces, nindices, has_vnorms, ntris, nnodes)
+    if pos + sum(struct.calcsize(code)*n for name, code, n in layout
+                 if n is not None) != len(view):
+        return None
+    arrays = {}
+    for name, code, n in layout:
+        if n is None:
+            arrays[name] = None
+            continue
+        end = pos + struct.calcsize(code)*n
+        arrays[name] = view[pos:end].cast(code)
+        pos = end
+    return MeshArrays(bounds=(bounds[:3], bounds[3:]),
+                      leaf_size=leaf_size or None, **arrays)
+
+
+def _as_array(code, values):
+    # array of type code holding values (a sequence or a cast memoryview)
+    if isinstance(values, array) and values.typecode == code:
+        return values
+    a = array(code)
+    if isinstance(values, memoryview) and values.format == code:
+        a.frombytes(values.cast("B"))
+    else:
+        a.extend(values)
+    return a
+
+
+def save(offname, key, arrays):
+    """write the cache for offname from MeshArrays arrays (whose optional
+    parts may be missing); returns False if it could not be written (e.g.
+    a read-only directory)
+    """
+    if sys.byteorder != "little":
+        return False
+    low, high = arrays.bounds
+    vnorms = arrays.vertex_normals is not None
+    nverts = len(arrays.vertices) // 3
+    nfaces, nindices = len(arrays.offsets) - 1, len(arrays.indices)
+    if arrays.leaf_size:
+        ntris, nnodes = len(arrays.faces), len(arrays.links) // 2
+    else:
+        ntris = nnodes = None
+    parts = [_HEADER.pack(MAGIC, key, nverts, nfaces, nindices, vnorms,
+                          ntris or 0, nnodes or 0, arrays.leaf_size or 0),
+             _BOUNDS.pack(*low, *high)]
+    for name, code, n in _layout(nverts, nfaces, nindices, vnorms, ntris,
+                                 nnodes):
+        if n is not None:
+            values = getattr(arrays, name)
+            if len(values) != n:
+                raise ValueError("{} has {} values, not {}".format(
+                    name, len(values), n))
+            parts.append(_as_array(code, values).tobytes())
+
+    # write to a temporary file and rename so readers never see a partial
+    # cache, even with several processes loading the same mesh
+    cname = cache_name(offname)
+    tmpname = "{}.{}.tmp".format(cname, os.getpid())
+    try:
+        with open(tmpname, "wb") as outfile:
+            outfile.writelines(parts)
+        os.replace(tmpname, cname)
+    except OSError:
+        try:
+            os.remove(tmpname)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def update(offname, key, **parts):
+    """store further parts (vertex_normals, or leaf_size and the arrays
+    of TRIANGLE_FIELDS) in the cache for offname, if it is there and made
+    from contents key; returns False if it is not (or could not be
+    written)
+    """
+    arrays = load(offname, key)
+    if arrays is None:
+        return False
+    for name, values in parts.items():
+        setattr(arrays, name, values)
+    return save(offname, key, arrays)
@@ -5,6 +5,7 @@
 from math import sin, cos, pi, sqrt, tau, acos, atan, atan2
 from ren3d.math3d import Point, Vector
 from ren3d.rgb import RGB
+from ren3d.bbox import BoundingBox
 from ren3d.materials import *
 
 
@@ -15,6 +16,7 @@ class Box:
     def __init__(self, pos=(0.0, 0.0, 0.0), size=(1, 1, 1), color=(0,0,0)):
         self.planes = [(pos[i]-size[i]/2, pos[i]+size[i]/2) for i in range(3)]
         self.color = make_material(color)
+        self.bbox = BoundingBox(*zip(*self.planes))
 
     def iter_polygons(self):
         ijseq = [(0, 0), (1, 0), (1, 1), (0, 1)]
@@ -33,7 +35,7 @@ class Box:
                      normals=[Vector((0, 0, 1))]*4, color=self.color)
 
     def intersect(self, ray, interval, info):
-        s, d = ray.start, ray.dir
+        s, d = tuple(ray.start), tuple(ray.dir)
         planes = self.planes
         hit = False
         for axis in range(3):
@@ -43,27 +45,43 @@ class Box:
                 t = (planes[axis][lh] - s[axis])/d[axis]
                 if t not in interval:
                     continue
-                p = ray.point_at(t)
-                if self._inrect(p, axis):
+                if self._inrect(s, d, t, axis):
                     hit = True
                     interval.high = t
                     info.t = t
-                    info.point = p
+                    info.point = ray.point_at(t)
                     info.normal = Vector([0]*3)
                     info.normal[axis] = (-1.0, 1.0)[lh]
                     info.color = self.color
         return hit
 
-    def _inrect(self, p, axis):
-        axes = [0, 1, 2]
-        axes.remove(axis)
-        for a in axes:
+    def occluder(self, ray, interval):
+        """ returns the box if ray hits it within interval, else None,
+        stopping at the first face found (see Group.occluder)
+        """
+        s, d = tuple(ray.start), tuple(ray.dir)
+        planes = self.planes
+        for axis in range(3):
+            if d[axis] == 0.0:
+                continue
+            for lh in range(2):
+                t = (planes[axis][lh] - s[axis])/d[axis]
+                if t in interval and self._inrect(s, d, t, axis):
+                    return self
+        return None
+
+    def _inrect(self, s, d, t, axis):
+        # is the point s + t*d within the face perpendicular to axis?
+        for a in _OTHER_AXES[axis]:
             low, high = self.planes[a]
-            if not low <= p[a] <= high:
+            if not low <= s[a] + t*d[a] <= high:
                 return False
         return True
 
 
+_OTHER_AXES = ((1, 2), (0, 2), (0, 1))
+
+
 class Sphere:
     """ Model of a sphere shape
     """
@@ -81,6 +99,8 @@ class Sphere:
         axis = Vector((0, radius, 0))
         self.northpole = self.pos + axis
         self.southpole = self.pos - axis
+        self.bbox = BoundingBox([c - radius for c in self.pos],
+                                [c + radius for c in self.pos])
 
     def _make_bands(self, nlat, nlong):
         # helper method that creates a list of "bands" where each band consists
@@ -109,13 +129,17 @@ class Sphere:
         self.bands = bands
 
     def iter_polygons(self):
+        # the band points are shared between polygons, so they serve as
+        # keys for per-vertex work such as lighting
         bands = self.bands
+        normal = self._normals()
         # arctic
         b = bands[0]
         for i in range(self.nlong):
             points = (self.northpole, b[i], b[i+1])
             yield Record(points=points, color=self.color,
-                         normals=[self.normal_at(p) for p in points])
+                         normals=[normal[id(p)] for p in points],
+                         keys=points)
         # inter-latitudes
         for b in range(len(bands)-1):
             b0 = bands[b]
@@ -123,13 +147,33 @@ class Sphere:
             for i in range(self.nlong):
                 quad = b0[i], b1[i], b1[i+1], b0[i+1]
                 yield Record(points=quad, color=self.color,
-                             normals=[self.normal_at(p) for p in quad])
+                             normals=[normal[id(p)] for p in quad],
+                             keys=quad)
         # antarctic
         b = bands[-1]
         for i in range(self.nlong):
             points = (self.southpole, b[i+1], b[i])
             yield Record(points=points, color=self.color,
-                         normals=[self.normal_at(p) for p in points])
+                         normals=[normal[id(p)] for p in points],
+                         keys=points)
+
+    def polygon_error(self):
+        """ greatest distance from the surface in to the polygons of
+        iter_polygons, whose vertices lie on the surface
+
+        >>> round(Sphere(radius=500).polygon_error(), 2)
+        13.28
+        """
+        return self.radius * (1 - cos(pi/self.nlong)
+                              * cos(pi/(2*(self.nlat+1))))
+
+    def _normals(self):
+        # normals at the poles and band points, keyed by id of the point
+        normal = {id(p): self.normal_at(p)
+                  for band in self.bands for p in band}
+        normal[id(self.northpole)] = self.normal_at(self.northpole)
+        normal[id(self.southpole)] = self.normal_at(self.southpole)
+        return normal
 
     def normal_at(self, pt):
         n = (pt-self.pos)
@@ -166,10 +210,29 @@ class Sphere:
         else:
             t = (-b + discrt)/(2*a)
             if t in interval:
-                self.setinfo(ray, t, info)
+                self._setinfo(ray, t, info)
                 return True
         return False
 
+    def occluder(self, ray, interval):
+        """ returns the sphere if ray hits it within interval, else None
+        (see Group.occluder)
+        """
+        dir = ray.dir
+        r = self.radius
+        s_p = ray.start-self.pos
+
+        a = dir.mag2()
+        b = 2 * dir.dot(s_p)
+        c = s_p.mag2() - r*r
+        discrim = b*b - 4 * a * c
+        if discrim <= 0:
+            return None
+        discrt = sqrt(discrim)
+        if (-b - discrt)/(2*a) in interval or (-b + discrt)/(2*a) in interval:
+            return self
+        return None
+
     def _setinfo(self, ray, t, info):
         # helper method to fill in the info record
         p = ray.point_at(t)
@@ -182,15 +245,63 @@ class Sphere:
 class Group:
     """ Model comprised of a group of other models.
     The contained models may be primitives (such as Sphere) or other groups.
+
+    accel optionally selects an acceleration structure that is built on
+    the first call to intersect (and rebuilt after further adds or a
+    change of accel):
+       None:   test every object in turn (the default)
+       "bvh":  bounding volume hierarchy (see ren3d.bvh)
+       "grid": uniform grid (see ren3d.grid)
+       "auto": grid for many objects of similar size, otherwise bvh
+    Objects without a bbox are always tested individually.
+
+    >>> g = Group(accel="auto")
+    >>> for x in range(-3, 4):
+    ...     g.add(Sphere(pos=(x, 0, -10), radius=.25))
+    >>> info = Record()
+    >>> from ren3d.ray3d import Ray, Interval
+    >>> g.intersect(Ray((2, 0, 0), (0, 0, -1)), Interval(), info)
+    True
+    >>> info.point
+    Point([2.0, 0.0, -9.75])
+    >>> g.bbox
+    BoundingBox((-3.25, -0.25, -10.25), (3.25, 0.25, -9.75))
+    >>> type(g._accel[0]).__name__
+    'BVH'
+    >>> g.accel = "grid"
+    >>> g.intersect(Ray((2, 0, 0), (0, 0, -1)), Interval(), info)
+    True
+    >>> type(g._accel[0]).__name__
+    'UniformGrid'
     """
 
-    def __init__(self):
+    def __init__(self, accel=None):
         self.objects = []
+        self.accel = accel
+
+    @property
+    def accel(self):
+        return self._accel_kind
+
+    @accel.setter
+    def accel(self, kind):
+        # the structure for the old kind (if built) no longer applies
+        self._accel_kind = kind
+        self._accel = None
 
     def add(self, model):
         """Add model to the group
         """
         self.objects.append(model)
+        self._accel = None
+
+    @property
+    def bbox(self):
+        """box enclosing all objects; AttributeError if any is unbounded"""
+        box = BoundingBox()
+        for obj in self.objects:
+            box.include_box(obj.bbox)
+        return box
 
     def iter_polygons(self):
         for obj in self.objects:
@@ -203,13 +314,97 @@ class Group:
         If so, info is the record of the first (in time) object hit, and
         interval.max is set to the time of the first hit.
         """
-        hit = False
-        for obj in self.objects:
+        if self.accel:
+            if self._accel is None:
+                self._accel = self._build_accel()
+            structure, unbounded = self._accel
+            hit = structure.intersect(ray, interval, info)
+            objects = unbounded
+        else:
+            hit = False
+            objects = self.objects
+        for obj in objects:
             if obj.intersect(ray, interval, info):
                 interval.high = info.t
                 hit = True
         return hit
 
+    def occluder(self, ray, interval):
+        """Returns the part of some object that ray hits within interval,
+        or None
+
+        This is the any-hit query for shadow rays: it stops at the first
+        object found to block the ray, which need not be the nearest, and
+        records nothing. Every model has an occluder method; a primitive
+        returns itself, a mesh one of its triangles and a group whatever
+        its object returned. The part returned is as small as possible,
+        so it is cheap to test again (by its own occluder method) for a
+        nearby ray.
+
+        >>> g = Group()
+        >>> g.add(Sphere(pos=(0, 0, -10), radius=1))
+        >>> g.add(Sphere(pos=(0, 0, -5), radius=1))
+        >>> from ren3d.ray3d import Ray, Interval
+        >>> g.occluder(Ray((0, 0, 0), (0, 0, -1)), Interval()) is g.objects[0]
+        True
+        >>> g.occluder(Ray((0, 0, 0), (0, 0, -1)), Interval(0, 3)) is None
+        True
+        """
+        if self.accel:
+            if self._accel is None:
+                self._accel = self._build_accel()
+            structure, objects = self._accel
+            blocker = structure.occluder(ray, interval)
+            if blocker is not None:
+                return blocker
+        else:
+            objects = self.objects
+        for obj in objects:
+            blocker = obj.occluder(ray, interval)
+            if blocker is not None:
+                return blocker
+        return None
+
+    def _build_accel(self):
+        # returns (structure, unbounded objects) for the chosen accelerator
+        # imported here because the accelerators use Record from this module
+        from ren3d.bvh import BVH
+        from ren3d.grid import UniformGrid
+
+        bounded, unbounded = [], []
+        for obj in self.objects:
+            try:
+                obj.bbox
+                bounded.append(obj)
+            except AttributeError:
+                unbounded.append(obj)
+        kind = self.accel
+        if kind == "auto":
+            kind = _choose_accel(bounded)
+        if kind == "grid":
+            structure = UniformGrid(bounded)
+        elif kind == "bvh":
+            structure = BVH.from_objects(bounded)
+        else:
+            raise ValueError("Unknown accelerator: {}".format(self.accel))
+        return structure, tuple(unbounded)
+
+
+def _choose_accel(objects):
+    # a grid works well for many objects of similar size; a bvh adapts
+    # to clustered scenes and objects of very different sizes
+    if len(objects) < 32:
+        return "bvh"
+    sizes = []
+    for obj in objects:
+        low, high = obj.bbox.bounds
+        sizes.append(max(h - l for l, h in zip(low, high)))
+    sizes.sort()
+    median = sizes[len(sizes)//2]
+    if median > 0 and sizes[-1] / median <= 4.0:
+        return "grid"
+    return "bvh"
+
 
 # ----------------------------------------------------------------------
 class Record(object):
@@ -234,18 +429,27 @@ class Record(object):
     >>> 
     """
 
+    # hit and polygon fields are slots; anything else goes in __dict__,
+    # which is only created when first needed
+    __slots__ = ("t", "point", "normal", "color", "points", "normals",
+                 "__dict__")
+
     def __init__(self, **items):
-        self.__dict__.update(items)
+        for k, v in items.items():
+            setattr(self, k, v)
 
     def update(self, **items):
-        self.__dict__.update(**items)
+        for k, v in items.items():
+            setattr(self, k, v)
 
     def __repr__(self):
-        d = self.__dict__
+        d = dict(self.__dict__)
+        for k in Record.__slots__[:-1]:
+            if hasattr(self, k):
+                d[k] = getattr(self, k)
         fields = [k+"="+str(d[k]) for k in sorted(d)]
         return "Record({})".format(", ".join(fields))
 
-
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
@@ -15,10 +15,23 @@ The viewer runs tkinter in a separate process so non graphical
 applications can display an image or sequence of images without being
 tkinter aware.
 
+A PPMViewer made with a size instead shows a frame kept in shared
+memory: the application writes pixels into viewer.frame and calls
+update() to say which part changed. Only that rectangle is sent, and
+updates are merged until the viewer's next refresh, so frequent updates
+(say one per scanline) cost next to nothing. The shared memory is freed
+by close(), or when the PPMViewer is garbage collected (or the program
+exits) without being closed.
+
 """
 
 import multiprocessing as mp
 import sys
+import weakref
+from multiprocessing import shared_memory
+
+# milliseconds between checks for new images or changed regions
+REFRESH_MS = 40
 
 
 class PPMViewer:
@@ -27,15 +40,30 @@ class PPMViewer:
     show() is called.
     """
 
-    def __init__(self, title):
+    def __init__(self, title, size=None):
         """ spawn separate process for viewing image
         A separate process is necessary so tk calls can be in the main thread
 
+        With size (width, height) the viewer displays a shared frame:
+        frame is a writable memoryview of its r, g, b bytes (top row
+        first), initially black, and update() marks parts to redraw.
         """
 
         self.pipe, childconn = mp.Pipe()
+        self.size = size
+        self.frame = None
+        shared = None
+        if size is not None:
+            width, height = size
+            self._shm = shared_memory.SharedMemory(
+                create=True, size=max(3*width*height, 1))
+            self.frame = self._shm.buf[:3*width*height]
+            # pending flag and the rectangle (x0, y0, x1, y1) to redraw
+            self._dirty = mp.Array("i", 5)
+            shared = (self._shm, size, self._dirty)
+            self._release = weakref.finalize(self, _release_frame, self._shm)
         self.process = mp.Process(target=viewer_process,
-                                  args=(childconn, title))
+                                  args=(childconn, title, shared))
         self.process.start()
         childconn.close()
 
@@ -43,6 +71,17 @@ class PPMViewer:
         """ display ppm image from file fname"""
         self.pipe.send(imgdata)
 
+    def update(self, rect=None):
+        """ mark part of the shared frame as changed
+
+        rect is (x0, y0, x1, y1): columns x0 to x1-1 of rows y0 to y1-1,
+        counting rows from the top; None means the whole frame. It is
+        merged with any other changes not yet drawn.
+        """
+        if rect is None:
+            rect = (0, 0) + tuple(self.size)
+        mark_dirty(self._dirty, rect)
+
     def isalive(self):
         """return Boolean indicating status of viewer window"""
         return self.process.is_alive()
@@ -52,19 +91,76 @@ class PPMViewer:
         if self.process.is_alive():
             self.pipe.send("")
             self.process.join()
+        if self.frame is not None:
+            self.frame.release()
+            self.frame = None
+            self._release()
 
     def wait(self):
         """wait for viewer to be closed"""
         self.process.join()
 
 
-def viewer_process(pipe, title):
+def _release_frame(shm):
+    # free the shared frame of a viewer, when it is closed or collected
+    try:
+        shm.close()
+    except BufferError:
+        pass    # other views of the frame remain; freed with them
+    shm.unlink()
+
+
+def mark_dirty(dirty, rect):
+    """merge rect (x0, y0, x1, y1) into the pending region of dirty, a
+    synchronized array of (pending, x0, y0, x1, y1)
+
+    >>> dirty = mp.Array("i", 5)
+    >>> mark_dirty(dirty, (2, 0, 4, 1))
+    >>> mark_dirty(dirty, (0, 3, 1, 5))
+    >>> take_dirty(dirty), take_dirty(dirty)
+    ((0, 0, 4, 5), None)
+    """
+    with dirty.get_lock():
+        x0, y0, x1, y1 = rect
+        if dirty[0]:
+            x0, y0 = min(x0, dirty[1]), min(y0, dirty[2])
+            x1, y1 = max(x1, dirty[3]), max(y1, dirty[4])
+        dirty[0:5] = [1, x0, y0, x1, y1]
+
+
+def take_dirty(dirty):
+    """return and clear the pending region of dirty, or None"""
+    with dirty.get_lock():
+        if not dirty[0]:
+            return None
+        dirty[0] = 0
+        return tuple(dirty[1:5])
+
+
+def ppm_region(frame, size, rect):
+    """ppm data for region rect (x0, y0, x1, y1, rows from the top) of
+    frame, the r, g, b bytes of an image of the given size
+
+    >>> ppm_region(bytes(range(12)), (2, 2), (1, 0, 2, 2))
+    b'P6\\n1 2\\n255\\n\\x03\\x04\\x05\\t\\n\\x0b'
+    """
+    width, height = size
+    x0, y0, x1, y1 = rect
+    rows = [frame[3*(width*y + x0):3*(width*y + x1)] for y in range(y0, y1)]
+    return b"".join([b"P6\n%d %d\n255\n" % (x1 - x0, y1 - y0)] + rows)
+
+
+def viewer_process(pipe, title, shared=None):
     # Display image in tk root window
     import tkinter as tk
     root = tk.Tk()
     root.title(title)
-    data = pipe.recv()
-    img = tk.PhotoImage(format="ppm", data=data, master=root)
+    if shared is None:
+        data = pipe.recv()
+        img = tk.PhotoImage(format="ppm", data=data, master=root)
+    else:
+        shm, size, dirty = shared
+        img = tk.PhotoImage(width=size[0], height=size[1], master=root)
     panel = tk.Label(root, image=img)
     panel.pack(side="bottom", fill="both", expand="yes")
 
@@ -77,7 +173,14 @@ def viewer_process(pipe, title):
                 sys.exit()
             img = tk.PhotoImage(format='ppm', data=data, master=root)
             panel.configure(image=img)
-        root.after(100, check_for_update)
+        if shared is not None:
+            # redraw the part of the shared frame changed since last time
+            rect = take_dirty(dirty)
+            if rect is not None and rect[0] < rect[2] and rect[1] < rect[3]:
+                data = ppm_region(shm.buf, size, rect)
+                root.tk.call(panel.cget("image"), "put", data,
+                             "-format", "ppm", "-to", rect[0], rect[1])
+        root.after(REFRESH_MS, check_for_update)
 
     root.after(0, check_for_update)
     root.mainloop()
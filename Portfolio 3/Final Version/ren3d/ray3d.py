@@ -9,6 +9,8 @@ from ren3d.math3d import Point, Vector
 
 class Ray:
 
+    __slots__ = ("start", "dir")
+
     def __init__(self, start, dir):
         """ A ray beginning at start going in direction dir.
         start is a point, and dir is a vector, both are represented
@@ -25,8 +27,9 @@ class Ray:
         >>> r.dir
         Vector([4.0, 5.0, 6.0])
         """
-        self.start = Point(start)
-        self.dir = Vector(dir)
+        # Points and Vectors are used as is (not copied)
+        self.start = start if type(start) is Point else Point(start)
+        self.dir = dir if type(dir) is Vector else Vector(dir)
 
     def __repr__(self):
         """ Returns printable and evalable representation of Ray
@@ -48,7 +51,7 @@ class Ray:
         >>> r.point_at(3.75)
         Point([3.75, 8.5, 13.25])
         """
-        return self.start + t*self.dir
+        return self.start.madd(t, self.dir)
 
 # ----------------------------------------------------------------------
 
@@ -57,6 +60,8 @@ class Interval:
 
     """Simple representation of an open interval"""
 
+    __slots__ = ("low", "high")
+
     def __init__(self, low=0.0, high=math.inf):
         """
         >>> myInterval = Interval()
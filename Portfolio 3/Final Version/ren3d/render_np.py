@@ -0,0 +1,478 @@
+# render_np.py
+#   Vectorized (NumPy) versions of the renderers. Rays and pixels are
+#   processed as whole arrays a block of rows at a time, and polygons as
+#   whole arrays of triangles. Results match the scalar renderers in
+#   render_ray and render_oo.
+#   Requires numpy.
+
+import numpy as np
+
+from ren3d.math3d import Point, Vector, EPSILON
+from ren3d.mesh import Mesh
+from ren3d.models import Sphere, Box, Group, Record
+from ren3d.ray3d import Ray, Interval
+from ren3d.render_oo import FrameBuffer, _backfacing, _frustum, _outside
+
+
+def raytrace_np(scene, img, updatefn=None, rows=16):
+    """raytrace scene into img processing rows rows of pixels at a time.
+
+    Computes the same image as render_ray.raytrace. Spheres and Boxes are
+    intersected in batch; any other kind of object falls back to its own
+    intersect method one ray at a time. updatefn (if given) is called
+    with the rectangle (x0, y0, x1, y1) of each batch of rows completed,
+    as render_ray.raytrace calls it for each row.
+    """
+    camera = scene.camera
+    w, h = img.size
+    camera.set_resolution(w, h)
+    l, b, r, t = camera.window
+    objects = list(_flatten(scene.surface))
+    materials = _Materials()
+    background = np.array(scene.background.quantize(255), dtype=np.uint8)
+    xs = l + (np.arange(w) + 0.5) * camera.dx
+    pix = np.asarray(img.view())
+
+    for j0 in range(0, h, rows):
+        j1 = min(j0 + rows, h)
+        ys = b + (np.arange(j0, j1) + 0.5) * camera.dy
+        dirs = np.empty((j1-j0, w, 3))
+        dirs[:, :, 0] = xs
+        dirs[:, :, 1] = ys[:, None]
+        dirs[:, :, 2] = -camera.distance
+        dirs = dirs.reshape(-1, 3)
+        starts = np.zeros_like(dirs)
+
+        hits = _closest_hits(objects, starts, dirs, 0.0, materials)
+        rgb = np.empty((len(dirs), 3), dtype=np.uint8)
+        rgb[:] = background
+        if hits.mask.any():
+            colors = _shade(scene, dirs[hits.mask], hits, objects, materials)
+            rgb[hits.mask] = _quantize(colors)
+
+        # image rows are stored top to bottom
+        pix[h-j1:h-j0] = rgb.reshape(j1-j0, w, 3)[::-1]
+        if updatefn:
+            updatefn((0, j0, w, j1))
+
+
+def render_gouraud_np(scene, img, cull_backfaces=False, cull_frustum=False):
+    """Render scene with Gouraud shaded polygons.
+
+    Computes the same image, and returns the same culling statistics, as
+    render_oo.render_gouraud. All the polygons are gathered into one
+    array of triangles, lit and projected together and rasterized in
+    chunks of many triangles (see _rasterize).
+
+    >>> from ren3d.scenedef import Scene
+    >>> from ren3d.image import Image
+    >>> from ren3d.render_oo import render_gouraud
+    >>> scene = Scene()
+    >>> scene.add(Box((1, 1, -7), (2, 2, 2), (0, 0, 1)))
+    >>> scene.add(Box((0, 0, 20), (2, 2, 2)))     # behind the eye
+    >>> render_gouraud_np(scene, Image((32, 24)), True, True)
+    Record(backfaces=3, objects=1, polygons=3)
+    >>> render_gouraud(scene, Image((32, 24)), True, True)
+    Record(backfaces=3, objects=1, polygons=3)
+    """
+    stats = Record(polygons=0, backfaces=0, objects=0)
+    tris = _gather_triangles(scene, cull_backfaces, cull_frustum, stats)
+    colors = _lambert_colors(scene, tris)
+    _rasterize(scene, img, tris.points, colors)
+    return stats
+
+
+def render_signature_np(scene, img, cull_backfaces=False,
+                        cull_frustum=False):
+    """Render signature view of scene, as render_oo.render_signature"""
+    stats = Record(polygons=0, backfaces=0, objects=0)
+    tris = _gather_triangles(scene, cull_backfaces, cull_frustum, stats)
+    colors = np.repeat(tris.colors[:, None, :], 3, axis=1)
+    _rasterize(scene, img, tris.points, colors)
+    return stats
+
+
+# ----------------------------------------------------------------------
+# batched intersection
+
+def _flatten(group):
+    # yield the primitive objects of a (possibly nested) group, in order
+    for obj in group.objects:
+        if isinstance(obj, Group):
+            yield from _flatten(obj)
+        else:
+            yield obj
+
+
+class _Materials:
+    # table mapping materials to small integer ids, with the lighting
+    # coefficients stacked into arrays for lookup by id
+
+    def __init__(self):
+        self.ids = {}
+        self.table = []
+
+    def id(self, material):
+        key = id(material)
+        if key not in self.ids:
+            self.ids[key] = len(self.table)
+            self.table.append(material)
+        return self.ids[key]
+
+    def arrays(self):
+        return (np.array([m.ambient.values for m in self.table]),
+                np.array([m.diffuse.values for m in self.table]),
+                np.array([m.specular.values for m in self.table]),
+                np.array([m.exponent for m in self.table], dtype=float))
+
+
+def _closest_hits(objects, starts, dirs, tlow, materials):
+    # returns Record(mask, t, points, normals, mat) for the closest hits of
+    # the rays (one per row of starts and dirs) within (tlow, inf)
+    n = len(dirs)
+    thigh = np.full(n, np.inf)
+    owner = np.full(n, -1)
+    points = np.zeros((n, 3))
+    normals = np.zeros((n, 3))
+    mat = np.zeros(n, dtype=int)
+    boxface = np.zeros(n, dtype=int)
+
+    for k, obj in enumerate(objects):
+        kind = type(obj)
+        if kind is Sphere:
+            hit, t = _sphere_hits(obj, starts, dirs, tlow, thigh)
+        elif kind is Box:
+            hit, t, face = _box_hits(obj, starts, dirs, tlow, thigh)
+            boxface[hit] = face[hit]
+        else:
+            hit, t = _scalar_hits(obj, starts, dirs, tlow, thigh,
+                                  points, normals, mat, materials)
+        thigh[hit] = t[hit]
+        owner[hit] = k
+
+    # fill in hit information for the batched primitives
+    for k, obj in enumerate(objects):
+        kind = type(obj)
+        if kind is not Sphere and kind is not Box:
+            continue
+        sel = owner == k
+        if not sel.any():
+            continue
+        t = thigh[sel, None]
+        p = t * dirs[sel] + starts[sel]
+        points[sel] = p
+        mat[sel] = materials.id(obj.color)
+        if kind is Sphere:
+            v = p - np.array(tuple(obj.pos))
+            m = np.sqrt(v[:, 0]*v[:, 0] + v[:, 1]*v[:, 1] + v[:, 2]*v[:, 2])
+            normals[sel] = v / m[:, None]
+        else:
+            face = boxface[sel]
+            nrm = np.zeros((len(face), 3))
+            nrm[np.arange(len(face)), face // 2] = np.where(face % 2, 1., -1.)
+            normals[sel] = nrm
+
+    return Record(mask=owner >= 0, t=thigh, points=points, normals=normals,
+                  mat=mat, owner=owner)
+
+
+def _any_hits(objects, starts, dirs, tlow, thigh):
+    # returns a boolean array: does each ray hit anything in (tlow, thigh)
+    n = len(dirs)
+    blocked = np.zeros(n, dtype=bool)
+    thigh = np.full(n, thigh)
+    for obj in objects:
+        kind = type(obj)
+        if kind is Sphere:
+            hit, t = _sphere_hits(obj, starts, dirs, tlow, thigh)
+        elif kind is Box:
+            hit, t, face = _box_hits(obj, starts, dirs, tlow, thigh)
+        else:
+            hit = np.array([obj.intersect(Ray(Point(s), Vector(d)),
+                                          Interval(tlow, th), Record())
+                            if not bl else False
+                            for s, d, th, bl in zip(starts, dirs, thigh,
+                                                    blocked)], dtype=bool)
+        blocked |= hit
+    return blocked
+
+
+def _sphere_hits(sphere, starts, dirs, tlow, thigh):
+    # same arithmetic as Sphere.intersect, for many rays at once
+    dx, dy, dz = dirs[:, 0], dirs[:, 1], dirs[:, 2]
+    cx, cy, cz = sphere.pos
+    sx, sy, sz = starts[:, 0] - cx, starts[:, 1] - cy, starts[:, 2] - cz
+    r = sphere.radius
+    a = dx*dx + dy*dy + dz*dz
+    b = 2 * (dx*sx + dy*sy + dz*sz)
+    c = (sx*sx + sy*sy + sz*sz) - r*r
+    discrim = b*b - 4 * a * c
+    pos = discrim > 0
+    discrt = np.sqrt(np.where(pos, discrim, 0.0))
+    t1 = (-b - discrt)/(2*a)
+    t2 = (-b + discrt)/(2*a)
+    in1 = pos & (tlow < t1) & (t1 < thigh)
+    in2 = pos & ~in1 & (tlow < t2) & (t2 < thigh)
+    return in1 | in2, np.where(in1, t1, t2)
+
+
+def _box_hits(box, starts, dirs, tlow, thigh):
+    # same arithmetic as Box.intersect, for many rays at once. Also
+    # returns the face hit as 2*axis + (0 for low plane, 1 for high)
+    planes = box.planes
+    high = np.array(thigh, dtype=float, copy=True)
+    face = np.full(len(dirs), -1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for axis in range(3):
+            d = dirs[:, axis]
+            s = starts[:, axis]
+            others = [a for a in range(3) if a != axis]
+            for lh in range(2):
+                t = (planes[axis][lh] - s)/d
+                ok = (d != 0.0) & (tlow < t) & (t < high)
+                for a in others:
+                    p = t*dirs[:, a] + starts[:, a]
+                    low_a, high_a = planes[a]
+                    ok &= (low_a <= p) & (p <= high_a)
+                high = np.where(ok, t, high)
+                face = np.where(ok, 2*axis + lh, face)
+    return face >= 0, high, face
+
+
+def _scalar_hits(obj, starts, dirs, tlow, thigh, points, normals, mat,
+                 materials):
+    # fall back to obj.intersect for each ray; hit info is stored directly
+    n = len(dirs)
+    hit = np.zeros(n, dtype=bool)
+    ts = np.zeros(n)
+    for k in range(n):
+        info = Record()
+        if obj.intersect(Ray(Point(starts[k]), Vector(dirs[k])),
+                         Interval(tlow, thigh[k]), info):
+            hit[k] = True
+            ts[k] = info.t
+            points[k] = tuple(info.point)
+            normals[k] = tuple(info.normal)
+            mat[k] = materials.id(info.color)
+    return hit, ts
+
+
+# ----------------------------------------------------------------------
+# batched rasterization
+
+def _gather_triangles(scene, backfaces, frustum, stats):
+    # returns Record(points, normals, colors) for all the triangles of the
+    # scene's polygons that survive culling, in drawing order: points and
+    # normals are T x 3 x 3 (triangle, corner, xyz) and colors T x 3 (the
+    # diffuse color of each triangle). Polygons are split into fans and
+    # culled (and counted in stats) like render_oo.culled_polygons does.
+    points, normals, colors = [], [], []
+    view = _frustum(scene.camera) if frustum else None
+    for obj in _unculled(scene.objects, view, stats):
+        if type(obj) is Mesh:
+            # read the mesh buffers directly, in iter_polygons order
+            tris = np.frombuffer(obj.tris, dtype=np.int32).reshape(-1, 3)
+            nids = np.frombuffer(obj.nids, dtype=np.int32).reshape(-1, 3)
+            verts = np.stack([np.frombuffer(a) for a in
+                              (obj.xs, obj.ys, obj.zs)], axis=-1)
+            norms = np.stack([np.frombuffer(a) for a in
+                              (obj.nxs, obj.nys, obj.nzs)], axis=-1)
+            pts, nrms = verts[tris], norms[nids]
+            if backfaces:
+                front = ((pts * nrms).sum(axis=2) <= 0).any(axis=1)
+                stats.backfaces += len(front) - int(front.sum())
+                pts, nrms = pts[front], nrms[front]
+            stats.polygons += len(pts)
+            points.append(pts)
+            normals.append(nrms)
+            colors.append(np.tile(_diffuse(obj.color), (len(pts), 1)))
+            continue
+        for poly in obj.iter_polygons():
+            if backfaces and _backfacing(poly):
+                stats.backfaces += 1
+                continue
+            stats.polygons += 1
+            pts = [tuple(p) for p in poly.points]
+            nrms = [tuple(n) for n in poly.normals]
+            for i in range(1, len(pts)-1):
+                points.append([[pts[0], pts[i], pts[i+1]]])
+                normals.append([[nrms[0], nrms[i], nrms[i+1]]])
+                colors.append([_diffuse(poly.color)])
+    if not points:
+        return Record(points=np.zeros((0, 3, 3)), normals=np.zeros((0, 3, 3)),
+                      colors=np.zeros((0, 3)))
+    return Record(points=np.concatenate([np.asarray(p, dtype=float)
+                                         for p in points]),
+                  normals=np.concatenate([np.asarray(n, dtype=float)
+                                          for n in normals]),
+                  colors=np.concatenate([np.asarray(c, dtype=float)
+                                         for c in colors]))
+
+
+def _unculled(group, view, stats):
+    # the primitive objects of group not outside view (if given), in
+    # order; the objects (or groups) culled are counted in stats
+    for obj in group.objects:
+        if view is not None and _outside(getattr(obj, "bbox", None), view):
+            stats.objects += 1
+        elif isinstance(obj, Group):
+            yield from _unculled(obj, view, stats)
+        else:
+            yield obj
+
+
+def _diffuse(color):
+    # rgb values drawn for a polygon color, which may be a Material
+    return getattr(color, "diffuse", color).values
+
+
+def _lambert_colors(scene, tris):
+    # as render_oo.lambert_colors for every corner of every triangle
+    eye = np.array(tuple(scene.camera.eye))
+    lvec = eye - tris.points
+    x, y, z = lvec[..., 0], lvec[..., 1], lvec[..., 2]
+    lvec = lvec / np.sqrt(x*x + y*y + z*z)[..., None]
+    lambert = np.maximum(0, _dot(lvec.reshape(-1, 3),
+                                 tris.normals.reshape(-1, 3)))
+    lambert = lambert.reshape(-1, 3, 1)
+    return tris.colors[:, None, :] * lambert + np.array(scene.ambient.values)
+
+
+def _rasterize(scene, img, points, colors, chunk=1 << 20):
+    # draw triangles (T x 3 x 3 camera space points) with corner colors
+    # (T x 3 x 3) into img, giving the same image as drawing them one
+    # after another with FrameBuffer.draw_filled_triangle.
+    #
+    # A later fragment replaces an earlier one only if it is strictly
+    # nearer, so each pixel ends up with its nearest fragment, the first
+    # drawn among equals. That rule lets each chunk of triangles be
+    # resolved at once with a sort, and then merged with the buffer.
+    camera = scene.camera
+    w, h = img.size
+    (sx, tx), (sy, ty) = FrameBuffer(img, camera.window).pixel_scale
+    out = np.empty((h, w, 3), dtype=np.uint8)
+    out[:] = scene.background.quantize(255)
+    depth = np.full(w*h, -np.inf)
+
+    # project all the vertices at once, then map them to pixels
+    near = -camera.distance
+    px, py, pz = points[..., 0], points[..., 1], points[..., 2]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        xs = np.trunc(sx*(near*px/pz) + tx + .5).astype(np.int64)
+        ys = np.trunc(sy*(near*py/pz) + ty + .5).astype(np.int64)
+
+    # edge functions A*x + B*y + C opposite each corner, as in
+    # draw_filled_triangle, with 1/f of the corner and the inside sign
+    edges = []
+    for k0, k1, k2 in ((1, 2, 0), (0, 2, 1), (0, 1, 2)):
+        x0, y0, x1, y1 = xs[:, k0], ys[:, k0], xs[:, k1], ys[:, k1]
+        A, B, C = y0-y1, x1-x0, x0*y1-x1*y0
+        f = A*xs[:, k2] + B*ys[:, k2] + C
+        edges.append((A, B, C, f))
+    ok = (edges[0][3] != 0) & (edges[1][3] != 0) & (edges[2][3] != 0)
+    with np.errstate(divide="ignore"):
+        edges = [(A, B, C, 1.0/f, np.sign(f)) for A, B, C, f in edges]
+
+    xmin = np.maximum(xs.min(axis=1), 0)
+    xmax = np.minimum(xs.max(axis=1), w-1)
+    ymin = np.maximum(ys.min(axis=1), 0)
+    ymax = np.minimum(ys.max(axis=1), h-1)
+    widths = xmax - xmin + 1
+    areas = np.where(ok & (xmin <= xmax) & (ymin <= ymax),
+                     widths * (ymax - ymin + 1), 0)
+
+    # chunks of consecutive triangles with about chunk pixels of boxes
+    ends = np.cumsum(areas)
+    start = 0
+    while start < len(areas):
+        done = ends[start-1] if start else 0
+        stop = max(int(np.searchsorted(ends, done + chunk, "right")),
+                   start + 1)
+        _rasterize_chunk(np.arange(start, stop), areas, widths, xmin, ymin,
+                         edges, points[..., 2], colors, w, h, depth, out)
+        start = stop
+
+    np.asarray(img.view())[:] = out[::-1]
+
+
+def _rasterize_chunk(tri, areas, widths, xmin, ymin, edges, zs, colors,
+                     w, h, depth, out):
+    # fragments of each triangle's (clipped) bounding box
+    counts = areas[tri]
+    tri = np.repeat(tri, counts)
+    if not len(tri):
+        return
+    first = np.cumsum(counts) - counts
+    local = np.arange(len(tri)) - np.repeat(first, counts)
+    x = xmin[tri] + local % widths[tri]
+    y = ymin[tri] + local // widths[tri]
+
+    # keep the fragments inside all three edges
+    inside = np.ones(len(tri), dtype=bool)
+    fs = []
+    for A, B, C, mul, sign in edges:
+        f = A[tri]*x + B[tri]*y + C[tri]
+        inside &= f*sign[tri] >= 0
+        fs.append(f)
+    tri, x, y = tri[inside], x[inside], y[inside]
+    bary = [f[inside]*mul[tri] for f, (A, B, C, mul, sign) in zip(fs, edges)]
+    z = bary[0]*zs[tri, 0] + bary[1]*zs[tri, 1] + bary[2]*zs[tri, 2]
+
+    # nearest fragment per pixel (first drawn among equals), then the
+    # depth test against what is already in the buffer
+    pix = y*w + x
+    order = np.lexsort((tri, -z, pix))
+    spix = pix[order]
+    win = order[np.r_[True, spix[1:] != spix[:-1]]]
+    win = win[z[win] > depth[pix[win]]]
+    depth[pix[win]] = z[win]
+
+    # colors only for the fragments that were drawn
+    alpha, beta, gamma = bary[0][win], bary[1][win], bary[2][win]
+    c = colors[tri[win]]
+    rgb = (alpha[:, None]*c[:, 0] + beta[:, None]*c[:, 1]
+           + gamma[:, None]*c[:, 2])
+    out[y[win], x[win]] = _quantize(rgb)
+
+
+# ----------------------------------------------------------------------
+# batched shading
+
+def _shade(scene, dirs, hits, objects, materials):
+    # returns colors (n x 3 floats) for the hit rays, following raycolor
+    sel = hits.mask
+    p, n, m = hits.points[sel], hits.normals[sel], hits.mat[sel]
+    ambient, diffuse, specular, exponent = materials.arrays()
+    lpos, lcol = scene.light
+    lpos = np.array(tuple(lpos))
+    lcol = np.array(lcol.values)
+
+    color = np.array(scene.ambient.values) * ambient[m]
+
+    to_light = lpos - p
+    shadowed = _any_hits(objects, p, to_light, EPSILON, 1.0)
+    lit = ~shadowed
+    if lit.any():
+        p, n, m, d = p[lit], n[lit], m[lit], dirs[lit]
+        lvec = _normalized(to_light[lit])
+        lambert = np.maximum(0, _dot(lvec, n))
+        c = color[lit] + lambert[:, None] * (diffuse[m] * lcol)
+        v = -_normalized(d)
+        hvec = _normalized(lvec + v)
+        spec = np.maximum(0, _dot(hvec, n)) ** exponent[m]
+        color[lit] = c + spec[:, None] * (specular[m] * lcol)
+    return color
+
+
+def _dot(a, b):
+    return a[:, 0]*b[:, 0] + a[:, 1]*b[:, 1] + a[:, 2]*b[:, 2]
+
+
+def _normalized(v):
+    # as Vector.normalized: scale by the reciprocal of the magnitude
+    return (1/np.sqrt(_dot(v, v)))[:, None] * v
+
+
+def _quantize(colors):
+    # as RGB.quantize(255), which rounds halves to even like np.rint
+    return np.minimum(np.rint(colors * 255), 255).astype(np.uint8)
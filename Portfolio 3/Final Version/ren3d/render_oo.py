@@ -1,13 +1,25 @@
 # render_oo.py
 # by: John Zelle
 
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import count, islice
 from math import inf
 
-from collections import namedtuple, defaultdict
+from collections import namedtuple
 import ren3d.matrix as mat
+from ren3d.image import Image
+from ren3d.materials import make_material
+from ren3d.math3d import unit
+from ren3d.models import Group, Record
 
+# Each renderer takes optional culling switches and returns a Record of
+# culling statistics (see culled_polygons):
+#    cull_backfaces: skip polygons facing away from the eye
+#    cull_frustum:   skip objects whose bounding box is outside the view
 
-def render_signature(scene, img):
+
+def render_signature(scene, img, cull_backfaces=False, cull_frustum=False):
     """Render signature view of scene
 
     All polygons are drawn with their assigned raw color
@@ -18,63 +30,321 @@ def render_signature(scene, img):
     img.clear(scene.background.quantize(255))
     d = -camera.distance
     fb = FrameBuffer(img, camera.window)
-    for poly in scene.objects.iter_polygons():
+    stats = Record(polygons=0, backfaces=0, objects=0)
+    for poly in culled_polygons(scene, cull_backfaces, cull_frustum, stats):
         # draw triangle fan of the projected polygon
         points = [(d*p.x/p.z, d*p.y/p.z, p.z) for p in poly.points]
-        colors = [poly.color]*3  # use polygon color for all 3 vertices
+        # use polygon (diffuse) color for all 3 vertices
+        colors = [_diffuse(poly.color)]*3
         for i in range(1, len(poly.points)-1):
             fb.draw_filled_triangle([points[0], points[i], points[i+1]], colors) 
+    return stats
 
 
-def render_wireframe(scene, img):
+def render_wireframe(scene, img, cull_backfaces=False, cull_frustum=False,
+                     depth=True):
     """Render wireframe view of scene into img
+
+    Edges shared by polygons with vertex keys are drawn once; the keys
+    are the polygon's vertex_keys if it has them (keys for a mesh also
+    tell the corner normals apart), else its keys. With depth False
+    lines are drawn over each other without depth testing. The returned
+    stats also count the lines drawn.
+
+    >>> import os, tempfile
+    >>> from ren3d.scenedef import Scene
+    >>> from ren3d.mesh import Mesh
+    >>> tmp = tempfile.TemporaryDirectory()
+    >>> offname = os.path.join(tmp.name, "quad.off")
+    >>> lines = ["OFF", "4 2 0", "-1 -1 -5", "1 -1 -5", "1 1 -5", "-1 1 -5",
+    ...          "3 0 1 2", "3 0 2 3"]
+    >>> with open(offname, "w") as outfile:
+    ...     for line in lines:
+    ...         print(line, file=outfile)
+    >>> scene = Scene()
+    >>> scene.add(Mesh(os.path.relpath(offname, "meshes"), (1, 1, 1)))
+    >>> render_wireframe(scene, Image((32, 24))).lines
+    5
+    >>> tmp.cleanup()
     """
     img.clear(scene.background.quantize(255))
     camera = scene.camera
     fb = FrameBuffer(img, camera.window)
     d = -camera.distance
-    for poly in scene.objects.iter_polygons():
+    stats = Record(polygons=0, backfaces=0, objects=0, lines=0)
+    drawn = set()
+    for poly in culled_polygons(scene, cull_backfaces, cull_frustum, stats):
         cam_points = [(d*p.x/p.z, d*p.y/p.z, p.z) for p in poly.points]
-        fb.draw_polygon(cam_points, poly.color)
+        keys = getattr(poly, "vertex_keys", None)
+        if keys is None:
+            keys = getattr(poly, "keys", None)
+        stats.lines += fb.draw_polygon(cam_points, _diffuse(poly.color),
+                                       depth, keys, drawn)
+    return stats
 
 
-def render_gouraud(scene, img):
+def render_gouraud(scene, img, cull_backfaces=False, cull_frustum=False):
     """Render scene with Gouraud shaded polygons"""
     width, height = img.size
     camera = scene.camera
     img.clear(scene.background.quantize(255))
     near = -camera.distance
     fb = FrameBuffer(img, camera.window)
-    for poly in scene.objects.iter_polygons():
+    stats = Record(polygons=0, backfaces=0, objects=0)
+    lit = {}   # vertex colors by key, shared by the polygons of a frame
+    for poly in culled_polygons(scene, cull_backfaces, cull_frustum, stats):
         points = [(near*v.x/v.z, near*v.y/v.z, v.z, 1)
                   for v in poly.points]
-        colors = lambert_colors(scene, poly)
+        colors = lambert_colors(scene, poly, lit)
         for i in range(1, len(poly.points)-1):
             tripoints = [points[0], points[i], points[i+1]]
             tricolors = [colors[0], colors[i], colors[i+1]]
             fb.draw_filled_triangle(tripoints, tricolors) 
+    return stats
+
+
+def render_deferred(scene, img, cull_backfaces=False, cull_frustum=False):
+    """Render scene with deferred Phong (Blinn) shading
+
+    A geometry pass rasterizes every polygon into a G-buffer (depth,
+    normal, camera space point and material id per pixel); a shading pass
+    then lights each covered pixel once with the ambient, diffuse and
+    specular terms of its Material, as render_ray does (but without
+    shadows). The returned stats also count the pixels shaded.
+
+    >>> from ren3d.scenedef import Scene
+    >>> from ren3d.models import Sphere
+    >>> from ren3d.image import Image
+    >>> scene = Scene()
+    >>> scene.set_light((5, 5, 0), (1, 1, 1))
+    >>> scene.add(Sphere((0, 0, -5), 1))
+    >>> img = Image((40, 40))
+    >>> stats = render_deferred(scene, img)
+    >>> 0 < stats.shaded < 40*40
+    True
+    """
+    camera = scene.camera
+    img.clear(scene.background.quantize(255))
+    near = -camera.distance
+    fb = FrameBuffer(img, camera.window, deferred=True)
+    stats = Record(polygons=0, backfaces=0, objects=0)
+    ids = {}          # material ids by id() of the polygon color
+    materials = []
+    for poly in culled_polygons(scene, cull_backfaces, cull_frustum, stats):
+        m = ids.get(id(poly.color))
+        if m is None:
+            m = ids[id(poly.color)] = len(materials)
+            materials.append(make_material(poly.color))
+        points = [(near*v.x/v.z, near*v.y/v.z, v.z) for v in poly.points]
+        cam_points = [(v.x, v.y, v.z) for v in poly.points]
+        normals = [(n.x, n.y, n.z) for n in poly.normals]
+        for i in range(1, len(poly.points)-1):
+            tri = (0, i, i+1)
+            fb.draw_deferred_triangle([points[k] for k in tri],
+                                      [normals[k] for k in tri],
+                                      [cam_points[k] for k in tri], m)
+    stats.shaded = fb.shade_deferred(scene.ambient, scene.light, materials)
+    return stats
+
+
+def render_gouraud_parallel(scene, img, workers=None, tile=64,
+                            cull_backfaces=False, cull_frustum=False):
+    """Render scene with Gouraud shaded polygons using worker processes
+
+    The polygons are lit and projected as in render_gouraud and their
+    triangles binned by the screen tiles (see render_ray.make_tiles) that
+    their pixel bounding boxes overlap. Each worker receives the
+    triangles once, when it starts, and rasterizes a tile's bin into a
+    tile sized FrameBuffer with its own depth buffer; finished tiles are
+    copied into img, which comes out the same as from render_gouraud.
+    workers defaults to the number of CPUs.
+    """
+    # imported here because render_ray imports this module
+    from ren3d.render_ray import make_tiles
 
-
-def lambert_colors(scene, poly):
+    camera = scene.camera
+    w, h = img.size
+    background = scene.background.quantize(255)
+    img.clear(background)
+    near = -camera.distance
+    stats = Record(polygons=0, backfaces=0, objects=0)
+    lit = {}
+    triangles = []
+    for poly in culled_polygons(scene, cull_backfaces, cull_frustum, stats):
+        points = [(near*v.x/v.z, near*v.y/v.z, v.z) for v in poly.points]
+        colors = [c.values for c in lambert_colors(scene, poly, lit)]
+        for i in range(1, len(points)-1):
+            triangles.append(((points[0], points[i], points[i+1]),
+                              (colors[0], colors[i], colors[i+1])))
+
+    # bin the triangles, keeping them in drawing order within each bin
+    (sx, tx), (sy, ty) = FrameBuffer(img, camera.window).pixel_scale
+    ncols = (w + tile - 1) // tile
+    bins = {}
+    for n, (pts, colors) in enumerate(triangles):
+        xs = [int(sx*p[0] + tx + .5) for p in pts]
+        ys = [int(sy*p[1] + ty + .5) for p in pts]
+        for row in range(max(min(ys), 0) // tile,
+                         min(max(ys), h-1) // tile + 1):
+            for col in range(max(min(xs), 0) // tile,
+                             min(max(xs), w-1) // tile + 1):
+                bins.setdefault(row*ncols + col, array("i")).append(n)
+
+    frame = Record(size=(w, h), window=camera.window, background=background,
+                   triangles=triangles)
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(frame,)) as pool:
+        jobs = []
+        for x0, y0, x1, y1 in make_tiles(w, h, tile):
+            tris = bins.get((y0//tile)*ncols + x0//tile)
+            if tris:
+                jobs.append(pool.submit(_raster_tile, (x0, y0, x1, y1), tris))
+        for job in as_completed(jobs):
+            (x0, y0, x1, y1), tile_img = job.result()
+            img.blit((x0, y0), tile_img)
+    return stats
+
+
+# the frame being rendered by a worker process (see render_gouraud_parallel)
+_worker_frame = None
+
+
+def _init_worker(frame):
+    global _worker_frame
+    _worker_frame = frame
+
+
+def _raster_tile(tile, tris):
+    # returns tile and the Image of the tile rendered from triangles tris
+    frame = _worker_frame
+    x0, y0, x1, y1 = tile
+    img = Image((x1 - x0, y1 - y0))
+    img.clear(frame.background)
+    fb = FrameBuffer(img, frame.window, frame=frame.size, origin=(x0, y0))
+    triangles = frame.triangles
+    for n in tris:
+        pts, colors = triangles[n]
+        fb.draw_filled_triangle(list(pts), list(colors))
+    return tile, img
+
+
+def culled_polygons(scene, backfaces=False, frustum=False, stats=None):
+    """generate the polygons of scene.objects that survive culling
+
+    Points are in camera coordinates (eye at the origin looking down -z).
+    With backfaces True, a polygon is dropped when the normal at every
+    vertex faces away from the eye. With frustum True, an object (or
+    group) is dropped whole when its bounding box lies outside the view
+    volume of scene.camera. stats, if given, is a Record whose polygons,
+    backfaces and objects counts are increased by the number of polygons
+    drawn, polygons culled as back faces and objects culled by the
+    frustum.
+
+    >>> from ren3d.scenedef import Scene
+    >>> from ren3d.models import Box
+    >>> scene = Scene()
+    >>> scene.add(Box((3, 3, -20), (2, 2, 2)))
+    >>> scene.add(Box((0, 0, 20), (2, 2, 2)))     # behind the eye
+    >>> stats = Record(polygons=0, backfaces=0, objects=0)
+    >>> len(list(culled_polygons(scene, True, True, stats)))
+    3
+    >>> stats
+    Record(backfaces=3, objects=1, polygons=3)
+    """
+    if stats is None:
+        stats = Record(polygons=0, backfaces=0, objects=0)
+    view = _frustum(scene.camera) if frustum else None
+    return _culled(scene.objects, backfaces, view, stats)
+
+
+def _culled(group, backfaces, view, stats):
+    for obj in group.objects:
+        if view is not None and _outside(getattr(obj, "bbox", None), view):
+            stats.objects += 1
+            continue
+        if isinstance(obj, Group):
+            yield from _culled(obj, backfaces, view, stats)
+            continue
+        for poly in obj.iter_polygons():
+            if backfaces and _backfacing(poly):
+                stats.backfaces += 1
+                continue
+            stats.polygons += 1
+            yield poly
+
+
+def _backfacing(poly):
+    # True when each vertex normal points away from the eye (the origin),
+    # i.e. the vector from the eye to the vertex has a positive dot
+    # product with the normal
+    for p, n in zip(poly.points, poly.normals):
+        if p.x*n.x + p.y*n.y + p.z*n.z <= 0:
+            return False
+    return True
+
+
+def _frustum(camera):
+    # the planes (a, b, c) of the view volume, through the eye, with
+    # a*x + b*y + c*z >= 0 inside; plus the plane z = 0 behind the eye
+    l, b, r, t = camera.window
+    d = camera.distance
+    return ((d, 0.0, l), (-d, 0.0, -r), (0.0, d, b), (0.0, -d, -t),
+            (0.0, 0.0, -1.0))
+
+
+def _outside(bbox, view):
+    # True when every corner of bbox is outside one of the view planes
+    if bbox is None:
+        return False
+    low, high = bbox.bounds
+    corners = [(x, y, z) for x in (low[0], high[0])
+               for y in (low[1], high[1]) for z in (low[2], high[2])]
+    for a, b, c in view:
+        if all(a*x + b*y + c*z < 0 for x, y, z in corners):
+            return True
+    return False
+
+
+def lambert_colors(scene, poly, cache=None):
     """return lambert shaded colors corresponding to veritices of polygon
 
     helper method for render_gouraud. The poly record will need to have:
        points: list of  vertices of the polygon
        normals: list of normal vectors (one for each point)
-       color: an RGB color of the polygon
+       color: an RGB color or a Material of the polygon
+    and may have:
+       keys: a hashable key for each vertex; vertices with equal keys
+             have the same point, normal and color
 
+    cache is an optional dict from keys to colors. Vertices whose key is
+    in it are not lit again, and newly lit ones are added.
     """
 
+    keys = getattr(poly, "keys", None) if cache is not None else None
     rgbs = []
     eye = scene.camera.eye
-    for pt, norm in zip(poly.points, poly.normals):
+    color = _diffuse(poly.color)
+    for i, (pt, norm) in enumerate(zip(poly.points, poly.normals)):
+        if keys is not None:
+            rgb = cache.get(keys[i])
+            if rgb is not None:
+                rgbs.append(rgb)
+                continue
         lvec = (eye-pt)
         lvec.normalize()
         lambert = max(0, lvec.dot(norm))
-        rgbs.append(poly.color * lambert + scene.ambient)
+        rgb = color * lambert + scene.ambient
+        if keys is not None:
+            cache[keys[i]] = rgb
+        rgbs.append(rgb)
     return rgbs
 
 
+def _diffuse(color):
+    # the RGB to draw for a polygon color, which may be a Material
+    return getattr(color, "diffuse", color)
+
+
 # ---------------------------------------------------------------------------
 # Helper class
 pixloc = namedtuple("pixloc", "x y z")
@@ -86,72 +356,166 @@ class FrameBuffer:
     and Render2d projects
 
     This version is updated to keep the z component of the points to use for 
-    depth buffering.
+    depth buffering. The depth buffer is a flat array of floats indexed by
+    y*width + x; larger z is nearer.
+
+    With deferred True there is also a G-buffer of the same layout: the
+    normal (x, y, z arrays), the camera space point (x, y, z arrays) and
+    the material id (-1 for empty) of the nearest surface at each pixel,
+    filled by draw_deferred_triangle and lit by shade_deferred.
+
+    With ids True, idbuff holds an int id (-1 for empty) of the nearest
+    triangle drawn with draw_id_triangle at each pixel.
+
+    img may also be one tile of a larger frame: frame is then the size of
+    the whole image the window is mapped to and origin the frame pixel at
+    the lower left of img. Pixels are located exactly as they would be in
+    the whole frame.
     """
 
-    def __init__(self, img, window):
+    def __init__(self, img, window, deferred=False, ids=False, frame=None,
+                 origin=(0, 0)):
         self.img = img
         self.size = img.size
+        self.origin = origin
         # viewport dimensions are 1 unit larger than pixel dimensions
-        w, h = self.size[0] + 1, self.size[1] + 1
+        w, h = frame or self.size
+        w, h = w + 1, h + 1
         l, b, r, t = window
         self.transform = [[w/(r-l), 0.0, 0.0, (-.5*r-(w-.5)*l)/(r-l)],
                           [0.0, h/(t-b), 0.0, (-.5*t-(h-.5)*b)/(t-b)],
                           [0.0, 0.0, 1.0, 0.0],
                           [0.0, 0.0, 0.0, 1.0]]
-        self.depthbuff = defaultdict(lambda: -inf)
+        # x and y scale and offset of the transform, for the rasterizers
+        self.pixel_scale = ((self.transform[0][0], self.transform[0][3]),
+                            (self.transform[1][1], self.transform[1][3]))
+        self.depthbuff = array("d", [-inf]) * (self.size[0]*self.size[1])
+        self.gbuffer = None
+        if deferred:
+            npix = self.size[0]*self.size[1]
+            self.gbuffer = Record(
+                normals=[array("d", [0.0]) * npix for i in range(3)],
+                points=[array("d", [0.0]) * npix for i in range(3)],
+                material=array("i", [-1]) * npix)
+        self.idbuff = None
+        if ids:
+            self.idbuff = array("i", [-1]) * (self.size[0]*self.size[1])
 
     def transpt(self, point):
         # Transform point from window (world) coordinates to pixel coordinates
         # x and y are ints, z is a float indicating depth
         x, y, z, _ = mat.apply(self.transform, point+(1,))
-        return pixloc(int(x + .5), int(y + .5), z)
+        ox, oy = self.origin
+        return pixloc(int(x + .5) - ox, int(y + .5) - oy, z)
 
     def set_pixel(self, loc, z, color):
         w, h = self.size
-        if 0 <= loc[0] < w and 0 <= loc[1] < h:
-            if z > self.depthbuff[loc]:
-                self.img[loc] = color.quantize(255)
-                self.depthbuff[loc] = z
-
-    def draw_line(self, a, b, rgb):
-        # pre: a and b are pixel locations (int, int, float)
-        if a[:2] == b[:2]:   # handle degenerate case same pixel location
-            self.set_pixel(a[:2], a.z, rgb)
-            return
-        # Otherwise, handle the general case
-        dx = b.x - a.x
-        dy = b.y - a.y
-        dz = b.z - a.z
-        if abs(dx) > abs(dy):  # x changes faster, walk it
-            if a.x > b.x:
-                a, b = b, a
-            yinc = dy/dx
-            y = a.y
-            zinc = dz/dx
-            z = a.z
-            for x in range(a.x, b.x + 1):
-                self.set_pixel((x, round(y)), z, rgb)
-                y += yinc
-                z += zinc
+        x, y = loc[0], loc[1]
+        if 0 <= x < w and 0 <= y < h:
+            i = y*w + x
+            if z > self.depthbuff[i]:
+                self.depthbuff[i] = z
+                self.img[x, y] = color.quantize(255)
+
+    def draw_line(self, a, b, rgb, depth=True):
+        """Draw the line between pixel locations a and b (int, int, float)
+
+        The line is clipped to the image before it is stepped, so only
+        pixels that are on screen are visited, and its pixels are chosen
+        with integer arithmetic (the nearest pixel to the line along the
+        slower changing axis, halves rounded up). With depth False the
+        depth buffer is neither tested nor updated.
+
+        >>> from ren3d.image import Image
+        >>> from ren3d.rgb import RGB
+        >>> fb = FrameBuffer(Image((4, 3)), (0, 0, 4, 3))
+        >>> white = RGB((1, 1, 1))
+        >>> fb.draw_line(pixloc(-5, -3, 0.0), pixloc(10, 4, 0.0), white)
+        >>> [(x, y) for y in range(3) for x in range(4) if fb.img[x, y][0]]
+        [(1, 0), (2, 0), (3, 1)]
+        """
+        w, h = self.size
+        (x0, y0, z0), (x1, y1, z1) = a, b
+        # step along the major axis u, the minor axis is v
+        xmajor = abs(x1-x0) > abs(y1-y0)
+        if xmajor:
+            u0, v0, u1, v1, umax, vmax = x0, y0, x1, y1, w-1, h-1
+        else:
+            u0, v0, u1, v1, umax, vmax = y0, x0, y1, x1, h-1, w-1
+        if u0 > u1:
+            u0, v0, z0, u1, v1, z1 = u1, v1, z1, u0, v0, z0
+        du, dv = u1 - u0, v1 - v0
+        if du == 0:   # both ends at the same pixel
+            klo = khi = 0
+            if not (0 <= u0 <= umax and 0 <= v0 <= vmax):
+                return
+        else:
+            # pixel k of the line is (u0 + k, v0 + (2*k*dv + du)//(2*du));
+            # clip k to the image (Liang-Barsky in integer form): the
+            # minor axis stays in range when lo <= 2*k*dv <= hi
+            klo, khi = max(-u0, 0), min(umax - u0, du)
+            lo = -2*v0*du - du
+            hi = 2*(vmax - v0 + 1)*du - du - 1
+            if dv > 0:
+                klo = max(klo, -(-lo // (2*dv)))
+                khi = min(khi, hi // (2*dv))
+            elif dv < 0:
+                klo = max(klo, -(-hi // (2*dv)))
+                khi = min(khi, lo // (2*dv))
+            elif not lo <= 0 <= hi:
+                return
+            if klo > khi:
+                return
+
+        n = khi - klo + 1
+        us = range(u0 + klo, u0 + khi + 1)
+        if du == 0:
+            vs = [v0]
+            zs = [z0]
         else:
-            if a.y > b.y:
-                a, b = b, a
-            xinc = dx/dy
-            x = a.x
-            zinc = dz/dy
-            z = a.z
-            for y in range(a.y, b.y + 1):
-                self.set_pixel((round(x), y), z, rgb)
-                x += xinc
-                z += zinc
-
-    def draw_polygon(self, points, color):
-        # points are 3D window points (tuple of floats)
-        pixels = [self.transpt(p) for p in points]
-        for i in range(len(pixels) - 1):
-            self.draw_line(pixels[i], pixels[i+1], color)
-        self.draw_line(pixels[-1], pixels[0], color)
+            vs = [v0 + (2*k*dv + du) // (2*du) for k in range(klo, khi+1)]
+            zinc = (z1 - z0)/du
+            zs = [z0 + k*zinc for k in range(klo, khi+1)]
+        xs, ys = (us, vs) if xmajor else (vs, us)
+        r, g, b = rgb.quantize(255)
+        pixels, depthbuff = self.img.pixels, self.depthbuff
+        if not depth:
+            for x, y in zip(xs, ys):
+                i = 3*(w*(h-y-1) + x)
+                pixels[i] = r
+                pixels[i+1] = g
+                pixels[i+2] = b
+            return
+        for x, y, z in zip(xs, ys, zs):
+            d = y*w + x
+            if z > depthbuff[d]:
+                depthbuff[d] = z
+                i = 3*(w*(h-y-1) + x)
+                pixels[i] = r
+                pixels[i+1] = g
+                pixels[i+2] = b
+
+    def draw_polygon(self, points, color, depth=True, keys=None, drawn=None):
+        # points are 3D window points (tuple of floats). Edges already
+        # drawn may be skipped by giving keys, a hashable key for each
+        # point, and drawn, the set of edges (frozensets of the keys of
+        # their ends) drawn so far, which is updated. Returns the number
+        # of lines drawn
+        (sx, tx), (sy, ty) = self.pixel_scale
+        ox, oy = self.origin
+        pixels = [pixloc(int(sx*p[0] + tx + .5) - ox,
+                         int(sy*p[1] + ty + .5) - oy, p[2])
+                  for p in points]
+        lines = 0
+        for i in range(len(pixels)):
+            if keys is not None:
+                edge = frozenset((keys[i-1], keys[i]))
+                if edge in drawn:
+                    continue
+                drawn.add(edge)
+            self.draw_line(pixels[i-1], pixels[i], color, depth)
+            lines += 1
+        return lines
 
     def draw_filled_triangle(self, pts, rgbs):
         """Draw a filled triangle, smoothly interpolating vertex 
@@ -159,45 +523,202 @@ class FrameBuffer:
         pts is a list 3D window points (tuple of floats)
         rgbs is a list of corresponding rbgs
 
+        The triangle is filled one scanline span at a time (see _spans);
+        depths and colors are plain floats and a span that passes the
+        depth test is stored with two slice assignments.
         """
-        # make pixlocs a, b, c
-        a, b, c = tuple(self.transpt(p) for p in pts)
         # make sure rgbs is a list of colors, one for each vertex
         if type(rgbs) != list:
             rgbs = [rgbs, rgbs, rgbs]
-
-        def linefunc(p0, p1):
-            x0, y0, _ = p0
-            x1, y1, _ = p1
-
-            def f(x, y):
-                return (y0-y1)*x + (x1-x0)*y + x0*y1-x1*y0
-
-            return f
-        try:
-            fbc = linefunc(b, c)
-            alphamul = 1 / fbc(a.x, a.y)
-            fac = linefunc(a, c)
-            betamul = 1 / fac(b.x, b.y)
-            fab = linefunc(a, b)
-            gammamul = 1 / fab(c.x, c.y)
-        except ZeroDivisionError:
-            # protection against degenerate triangles
-            return
-
-        for x in range(min(a.x, b.x, c.x), max(a.x, b.x, c.x)+1):
-            for y in range(min(a.y, b.y, c.y), max(a.y, b.y, c.y)+1):
-                alpha = fbc(x, y) * alphamul
-                if alpha < 0:
-                    continue
-                beta = fac(x, y) * betamul
-                if beta < 0:
-                    continue
-                gamma = fab(x, y) * gammamul
-                if gamma < 0:
-                    continue
-
-                # point is inside draw it with interpolated z and color
-                z = alpha*a.z + beta*b.z + gamma*c.z
-                rgb = alpha*rgbs[0] + beta*rgbs[1] + gamma*rgbs[2]
-                self.set_pixel((x, y), z, rgb)
+        w, h = self.size
+        pixels = self.img.pixels
+        (r0, g0, b0), (r1, g1, b1), (r2, g2, b2) = rgbs
+        for y, lo, alphas, betas, gammas, front in self._spans(pts):
+            i = 3*(w*(h-y-1) + lo)
+            n = len(alphas)
+            if len(front) == n:
+                span = [0] * (3*n)
+                span[0::3] = [min(round((alpha*r0 + beta*r1 + gamma*r2)*255),
+                                  255)
+                              for alpha, beta, gamma in zip(alphas, betas,
+                                                            gammas)]
+                span[1::3] = [min(round((alpha*g0 + beta*g1 + gamma*g2)*255),
+                                  255)
+                              for alpha, beta, gamma in zip(alphas, betas,
+                                                            gammas)]
+                span[2::3] = [min(round((alpha*b0 + beta*b1 + gamma*b2)*255),
+                                  255)
+                              for alpha, beta, gamma in zip(alphas, betas,
+                                                            gammas)]
+                pixels[i:i+3*n] = array("B", span)
+                continue
+            # partly hidden span: store the visible pixels one at a time
+            for k in front:
+                alpha, beta, gamma = alphas[k], betas[k], gammas[k]
+                j = i + 3*k
+                pixels[j] = min(round((alpha*r0 + beta*r1 + gamma*r2)*255),
+                                255)
+                pixels[j+1] = min(round((alpha*g0 + beta*g1 + gamma*g2)*255),
+                                  255)
+                pixels[j+2] = min(round((alpha*b0 + beta*b1 + gamma*b2)*255),
+                                  255)
+
+    def draw_deferred_triangle(self, pts, normals, points, material):
+        """Rasterize a triangle into the G-buffer (geometry pass)
+
+        pts is a list of 3D window points (tuple of floats), normals and
+        points the corresponding vertex normals and camera space points
+        and material an int id. Normals and points are interpolated
+        linearly in screen space, like depth.
+        """
+        gbuf = self.gbuffer
+        w = self.size[0]
+        # (buffer, value at each vertex) for each coordinate
+        attrs = list(zip(gbuf.normals + gbuf.points,
+                         *[n + p for n, p in zip(normals, points)]))
+        mats = gbuf.material
+        for y, lo, alphas, betas, gammas, front in self._spans(pts):
+            d = y*w + lo
+            n = len(alphas)
+            if len(front) == n:
+                for buf, v0, v1, v2 in attrs:
+                    buf[d:d+n] = array("d", [alpha*v0 + beta*v1 + gamma*v2
+                                             for alpha, beta, gamma in
+                                             zip(alphas, betas, gammas)])
+                mats[d:d+n] = array("i", [material]) * n
+                continue
+            for k in front:
+                alpha, beta, gamma = alphas[k], betas[k], gammas[k]
+                for buf, v0, v1, v2 in attrs:
+                    buf[d+k] = alpha*v0 + beta*v1 + gamma*v2
+                mats[d+k] = material
+
+    def draw_id_triangle(self, pts, ident):
+        """Rasterize a triangle of 3D window points into the id buffer
+
+        Only depths and the int ident are stored, e.g. to find which
+        object is visible at each pixel.
+        """
+        idbuff = self.idbuff
+        w = self.size[0]
+        for y, lo, alphas, betas, gammas, front in self._spans(pts):
+            d = y*w + lo
+            n = len(alphas)
+            if len(front) == n:
+                idbuff[d:d+n] = array("i", [ident]) * n
+                continue
+            for k in front:
+                idbuff[d+k] = ident
+
+    def shade_deferred(self, ambient, light, materials):
+        """Light every covered pixel of the G-buffer (shading pass)
+
+        Uses the Blinn-Phong model of render_ray.raycolor (without
+        shadows): ambient is the scene ambient RGB, light a (position,
+        RGB) pair and materials a list of Materials indexed by material
+        id. Returns the number of pixels shaded.
+        """
+        gbuf = self.gbuffer
+        w, h = self.size
+        (lx, ly, lz), lcol = light
+        coefs = [(ambient.times(m.ambient).values,
+                  m.diffuse.times(lcol).values,
+                  m.specular.times(lcol).values, m.exponent)
+                 for m in materials]
+        nxs, nys, nzs = gbuf.normals
+        pxs, pys, pzs = gbuf.points
+        mats = gbuf.material
+        pixels = self.img.pixels
+        shaded = 0
+        for d in range(w*h):
+            m = mats[d]
+            if m < 0:
+                continue
+            (ar, ag, ab), (dr, dg, db), (sr, sg, sb), exponent = coefs[m]
+            nx, ny, nz = unit(nxs[d], nys[d], nzs[d])
+            px, py, pz = pxs[d], pys[d], pzs[d]
+            # light and view (toward the eye at the origin) directions
+            vx, vy, vz = unit(lx-px, ly-py, lz-pz)
+            lambert = max(0, vx*nx + vy*ny + vz*nz)
+            ex, ey, ez = unit(-px, -py, -pz)
+            hx, hy, hz = unit(vx+ex, vy+ey, vz+ez)
+            specular = max(0, hx*nx + hy*ny + hz*nz)**exponent
+            y, x = divmod(d, w)
+            i = 3*(w*(h-y-1) + x)
+            pixels[i] = min(round((ar + dr*lambert + sr*specular)*255), 255)
+            pixels[i+1] = min(round((ag + dg*lambert + sg*specular)*255), 255)
+            pixels[i+2] = min(round((ab + db*lambert + sb*specular)*255), 255)
+            shaded += 1
+        return shaded
+
+    def _spans(self, pts):
+        # Generate the visible spans of the triangle with 3D window points
+        # pts as (y, lo, alphas, betas, gammas, front): row y from x = lo,
+        # the barycentric coordinates of each pixel and the offsets in the
+        # span of pixels that pass the depth test, whose depths are
+        # already stored. Spans with nothing visible are skipped.
+        #
+        # The integer edge functions give the ends of each row's span
+        # directly and are stepped along it.
+
+        # make pixel locations a, b, c (the same mapping as transpt)
+        (sx, tx), (sy, ty) = self.pixel_scale
+        ox, oy = self.origin
+        (ax, ay, az), (bx, by, bz), (cx, cy, cz) = [
+            (int(sx*p[0] + tx + .5) - ox, int(sy*p[1] + ty + .5) - oy, p[2])
+            for p in pts]
+        # edge function f(x, y) = A*x + B*y + C of the edge opposite each
+        # vertex, scaled by mul so that it is 1 at that vertex; the
+        # barycentric coordinates are f(x, y)*mul
+        edges = []
+        for (x0, y0), (x1, y1), (px, py) in (((bx, by), (cx, cy), (ax, ay)),
+                                             ((ax, ay), (cx, cy), (bx, by)),
+                                             ((ax, ay), (bx, by), (cx, cy))):
+            A, B, C = y0-y1, x1-x0, x0*y1-x1*y0
+            f = A*px + B*py + C
+            if f == 0:
+                return   # degenerate triangle
+            edges.append((A, B, C, 1/f))
+        (aA, aB, aC, amul), (bA, bB, bC, bmul), (cA, cB, cC, cmul) = edges
+        # the same edges with signs flipped so that inside is f >= 0
+        inside = [(A, B, C) if mul > 0 else (-A, -B, -C)
+                  for A, B, C, mul in edges]
+
+        # only visit the part of the bounding box that is on screen
+        w, h = self.size
+        xmin, xmax = max(min(ax, bx, cx), 0), min(max(ax, bx, cx), w-1)
+        ymin, ymax = max(min(ay, by, cy), 0), min(max(ay, by, cy), h-1)
+
+        depthbuff = self.depthbuff
+        for y in range(ymin, ymax+1):
+            # span of x where every edge function is >= 0
+            lo, hi = xmin, xmax
+            for A, B, C in inside:
+                e = B*y + C
+                if A > 0:
+                    lo = max(lo, -(e // A))
+                elif A < 0:
+                    hi = min(hi, e // -A)
+                elif e < 0:
+                    hi = lo - 1
+            if lo > hi:
+                continue
+            n = hi - lo + 1
+            alphas = [f*amul for f in islice(count(aA*lo + aB*y + aC, aA), n)]
+            betas = [f*bmul for f in islice(count(bA*lo + bB*y + bC, bA), n)]
+            gammas = [f*cmul for f in islice(count(cA*lo + cB*y + cC, cA), n)]
+            zs = [alpha*az + beta*bz + gamma*cz
+                  for alpha, beta, gamma in zip(alphas, betas, gammas)]
+
+            # depth test before any color work
+            d = y*w + lo
+            old = depthbuff[d:d+n]
+            front = [k for k in range(n) if zs[k] > old[k]]
+            if not front:
+                continue
+            if len(front) == n:
+                depthbuff[d:d+n] = array("d", zs)
+            else:
+                for k in front:
+                    depthbuff[d+k] = zs[k]
+            yield y, lo, alphas, betas, gammas, front
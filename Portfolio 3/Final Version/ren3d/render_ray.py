@@ -4,14 +4,22 @@
 
 
 from math import * 
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from ren3d.ray3d import *
 from ren3d.math3d import *
 from ren3d.models import *
 from ren3d.rgb import RGB
+from ren3d.image import Image
+from ren3d.render_oo import FrameBuffer
 
 
 def raytrace(scene, img, updatefn=None):
     """basic raytracing algorithm to render scene into img
+
+    updatefn (if given) is called as each row is finished with the
+    rectangle (x0, y0, x1, y1) of the pixels done, e.g. img.show.
     """
     camera = scene.camera
     w, h = img.size
@@ -22,7 +30,443 @@ def raytrace(scene, img, updatefn=None):
             color = raycolor(scene, ray, Interval())
             img[i, j] = color.quantize(255)
         if updatefn:
-            updatefn()
+            updatefn((0, j, w, j+1))
+
+
+def raytrace_parallel(scene, img, updatefn=None, workers=None, tile=32):
+    """raytrace scene into img using a pool of worker processes
+
+    The image is split into tiles (see make_tiles) that are traced
+    independently. Each worker receives the scene once, when it starts;
+    finished tiles are copied into img and updatefn (if given) is called
+    with each tile as it is copied. workers defaults to the number of
+    CPUs.
+    """
+    camera = scene.camera
+    w, h = img.size
+    camera.set_resolution(w, h)
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(scene,)) as pool:
+        jobs = [pool.submit(_trace_tile, t) for t in make_tiles(w, h, tile)]
+        for job in as_completed(jobs):
+            (x0, y0, x1, y1), rows = job.result()
+            for j, row in zip(range(y0, y1), rows):
+                img.set_row(j, row, x0)
+            if updatefn:
+                updatefn((x0, y0, x1, y1))
+
+
+def make_tiles(w, h, size=32):
+    """returns list of (x0, y0, x1, y1) tiles covering a w x h image,
+    starting from the top row of tiles
+
+    >>> make_tiles(5, 3, 2)
+    [(0, 2, 2, 3), (2, 2, 4, 3), (4, 2, 5, 3), (0, 0, 2, 2), (2, 0, 4, 2), (4, 0, 5, 2)]
+    """
+    return [(x, y, min(x+size, w), min(y+size, h))
+            for y in reversed(range(0, h, size))
+            for x in range(0, w, size)]
+
+
+# the scene being rendered by a worker process (see raytrace_parallel)
+_worker_scene = None
+
+
+def _init_worker(scene):
+    global _worker_scene
+    _worker_scene = scene
+
+
+def _trace_tile(tile):
+    # returns tile and a list of pixel rows (arrays of bytes) for rows y0..y1
+    scene = _worker_scene
+    camera = scene.camera
+    x0, y0, x1, y1 = tile
+    rows = []
+    for j in range(y0, y1):
+        row = array("B")
+        for i in range(x0, x1):
+            color = raycolor(scene, camera.ij_ray(i, j), Interval())
+            row.extend(color.quantize(255))
+        rows.append(row)
+    return tile, rows
+
+
+def raytrace_hybrid(scene, img, updatefn=None, margin=2):
+    """raytrace scene into img, finding primary visibility by rasterizing
+
+    The polygons of the objects are first rasterized into a buffer of
+    ids (see primary_ids). Where every pixel within margin of a pixel
+    shows the same object, its primary ray is intersected with just that
+    object, or not traced at all over the background; near the edges of
+    objects it is intersected with each object seen within margin. For a
+    mesh the triangle rasterized at the pixel is tested first, so the
+    mesh's hierarchy only has to look for something closer. Shading and
+    shadow rays are as in raycolor, so the image is the same as
+    raytrace's as long as the polygons of each object lie within margin
+    pixels of its true outline. Objects whose polygons only approximate
+    them (those having polygon_error, such as spheres) are also
+    intersected around their polygons as far as the error may reach on
+    the screen (see _fringe).
+
+    Where one object passes through another both show in the ids along
+    the line where they cross, so pixels near it are intersected with
+    both. Objects reaching behind the eye are not rasterized and are
+    intersected at every pixel.
+
+    updatefn (if given) is called as in raytrace. Returns a Record
+    counting the pixels whose primary ray was traced against one object
+    (interior), several (edge) or none (background).
+
+    >>> from ren3d.scenedef import Scene
+    >>> from ren3d.image import Image
+    >>> scene = Scene()
+    >>> scene.add(Sphere((0, 0, -5), 1, (1, 0, 0)))
+    >>> scene.add(Box((1, 1, -7), (2, 2, 2), (0, 0, 1)))
+    >>> traced, hybrid = Image((32, 24)), Image((32, 24))
+    >>> raytrace(scene, traced)
+    >>> stats = raytrace_hybrid(scene, hybrid)
+    >>> hybrid.pixels == traced.pixels
+    True
+    >>> stats.interior + stats.edge + stats.background
+    768
+
+    A sphere sunk into a box
+    >>> scene = Scene()
+    >>> scene.add(Sphere((0, 0, -5), 1, (1, 0, 0)))
+    >>> scene.add(Box((0, -1, -5), (3, 1, 3), (0, 0, 1)))
+    >>> traced, hybrid = Image((32, 24)), Image((32, 24))
+    >>> raytrace(scene, traced)
+    >>> stats = raytrace_hybrid(scene, hybrid)
+    >>> hybrid.pixels == traced.pixels
+    True
+
+    The outline of a large (here coarsely divided) sphere lies pixels
+    outside its polygons
+    >>> scene = Scene()
+    >>> scene.camera.set_perspective(60, 4/3, 50)
+    >>> scene.add(Sphere((0, 0, -1200), 500, nlat=7, nlong=8))
+    >>> scene.add(Box((0, 0, -3000), (4000, 4000, 10), (0, 0, 1)))
+    >>> traced, hybrid = Image((80, 60)), Image((80, 60))
+    >>> raytrace(scene, traced)
+    >>> stats = raytrace_hybrid(scene, hybrid)
+    >>> hybrid.pixels == traced.pixels
+    True
+    """
+    camera = scene.camera
+    w, h = img.size
+    camera.set_resolution(w, h)
+    objects, bases, ids, always = primary_ids(scene, w, h)
+    owners = array("i", [bisect_right(bases, ident) - 1 if ident >= 0 else -1
+                         for ident in ids])
+    uniform = _uniform(owners, w, h, margin)
+    fringe = _fringe(camera, objects, always, w, h)
+    background = scene.background
+    empty = background.quantize(255)
+    stats = Record(interior=0, edge=0, background=0)
+    for j in range(h):
+        row = j*w
+        for i in range(w):
+            k = owners[row+i]
+            extra = fringe.get(row+i)
+            if uniform[row+i] and not always and not extra:
+                if k < 0:
+                    img[i, j] = empty
+                    stats.background += 1
+                    continue
+                seen = (k,)
+                stats.interior += 1
+            else:
+                near = set()
+                for y in range(max(j-margin, 0), min(j+margin+1, h)):
+                    near.update(owners[y*w+max(i-margin, 0):
+                                       y*w+min(i+margin+1, w)])
+                near.discard(-1)
+                if extra:
+                    near.update(extra)
+                seen = sorted(near.union(always))
+                stats.edge += 1
+            ray = camera.ij_ray(i, j)
+            info = Record()
+            interval = Interval()
+            hit = False
+            for n in seen:
+                obj = objects[n]
+                if n == k and ids[row+i] > bases[k]:
+                    # test the triangle seen here first; the mesh then
+                    # only looks for something closer
+                    if obj.intersect_triangles(ray, interval, info,
+                                               (ids[row+i] - bases[k] - 1,)):
+                        hit = True
+                if obj.intersect(ray, interval, info):
+                    interval.high = info.t
+                    hit = True
+            color = _shade(scene, ray, info) if hit else background
+            img[i, j] = color.quantize(255)
+        if updatefn:
+            updatefn((0, j, w, j+1))
+    return stats
+
+
+def primary_ids(scene, w, h):
+    """returns (objects, bases, ids, always) for primary visibility
+
+    objects lists the primitive objects of scene (groups are flattened).
+    Object k has the id bases[k], and a mesh (having intersect_triangles)
+    also the ids bases[k] + 1 + triangle. ids is a flat int array (index
+    j*w + i, -1 for nothing) of the id whose rasterized polygon is
+    nearest at each pixel of a w x h image, sampled at the same points
+    as camera.ij_ray. always lists the objects (indexes) that reach
+    behind the eye, which are not rasterized.
+    """
+    camera = scene.camera
+    l, b, r, t = camera.window
+    # FrameBuffer spreads the window over one more pixel than the image
+    # has, so widen it by a pixel to sample at the ray positions
+    fb = FrameBuffer(Image((w, h)),
+                     (l, b, r + (r-l)/w, t + (t-b)/h), ids=True)
+    near = -camera.distance
+    objects = list(_primitives(scene.surface))
+    bases = []
+    always = []
+    base = 0
+    for k, obj in enumerate(objects):
+        bases.append(base)
+        polys = list(obj.iter_polygons())
+        step = 1 if hasattr(obj, "intersect_triangles") else 0
+        if any(p.z >= 0 for poly in polys for p in poly.points):
+            always.append(k)
+        else:
+            # depth is -1/z, which (unlike z) varies linearly across the
+            # screen, so the nearest id is found even for large polygons
+            for n, poly in enumerate(polys):
+                points = [(near*p.x/p.z, near*p.y/p.z, -1/p.z)
+                          for p in poly.points]
+                for i in range(1, len(points)-1):
+                    fb.draw_id_triangle([points[0], points[i], points[i+1]],
+                                        base + step*(n+1))
+        base += 1 + step*len(polys)
+    return objects, bases, fb.idbuff, always
+
+
+def _primitives(group):
+    # the non-group objects of group, in order
+    for obj in group.objects:
+        if isinstance(obj, Group):
+            yield from _primitives(obj)
+        else:
+            yield obj
+
+
+def _fringe(camera, objects, always, w, h):
+    # pixels where an object whose polygons lie inside its surface (one
+    # having polygon_error) may show although the ids do not say so,
+    # mapped to lists of the indexes of such objects: those outside the
+    # object's polygons but within the most its error can span on the
+    # screen. The polygons are taken to cover an interval of each row, as
+    # a sphere's do.
+    l, b, r, t = camera.window
+    sx, sy = w/(r-l), h/(t-b)
+    d = camera.distance
+    fringe = {}
+    for k, obj in enumerate(objects):
+        if k in always or not hasattr(obj, "polygon_error"):
+            continue
+        error = obj.polygon_error()
+        polys = [[(-d*p.x/p.z, -d*p.y/p.z, -p.z) for p in poly.points]
+                 for poly in obj.iter_polygons()]
+        depth = min(z for poly in polys for x, y, z in poly) - error
+        slope = max(max(abs(x), abs(y))/d for poly in polys
+                    for x, y, z in poly)
+        if depth > 0:
+            # a length error at depth (or more) and slope (or less) from
+            # the view axis spans at most this many pixels, plus one for
+            # rounding
+            pad = error*d/depth*hypot(1, slope)*max(sx, sy) + 1
+        else:
+            pad = w + h
+        # the span of the polygons along each row (at the pixel centers),
+        # for the rows within pad of the image as well
+        rows = int(pad) + 1
+        lows, highs = [inf]*(h + 2*rows), [-inf]*(h + 2*rows)
+        for poly in polys:
+            pts = [((x-l)*sx - .5, (y-b)*sy - .5) for x, y, z in poly]
+            for (xa, ya), (xb, yb) in zip(pts, pts[1:] + pts[:1]):
+                if ya > yb:
+                    xa, ya, xb, yb = xb, yb, xa, ya
+                for j in range(max(ceil(ya), -rows),
+                               min(floor(yb), h+rows-1) + 1):
+                    if yb > ya:
+                        xs = (xa + (xb-xa)*(j-ya)/(yb-ya),)
+                    else:
+                        xs = (xa, xb)
+                    for x in xs:
+                        lows[j+rows] = min(lows[j+rows], x)
+                        highs[j+rows] = max(highs[j+rows], x)
+        for j in range(h):
+            low = min(lows[j:j+2*rows+1]) - pad
+            high = max(highs[j:j+2*rows+1]) + pad
+            if low > high:
+                continue
+            if lows[j+rows] <= highs[j+rows]:
+                inside = range(ceil(lows[j+rows]), floor(highs[j+rows]) + 1)
+            else:
+                inside = range(0)
+            for i in range(max(ceil(low), 0), min(floor(high), w-1) + 1):
+                if i not in inside:
+                    fringe.setdefault(j*w + i, []).append(k)
+    return fringe
+
+
+def _uniform(ids, w, h, margin):
+    # bytearray flagging the pixels where all ids within margin are equal
+    # (separable min and max filters)
+    lows, highs = array("i", ids), array("i", ids)
+    for j in range(h):
+        row = ids[j*w:(j+1)*w]
+        spans = [row[max(i-margin, 0):i+margin+1] for i in range(w)]
+        lows[j*w:(j+1)*w] = array("i", map(min, spans))
+        highs[j*w:(j+1)*w] = array("i", map(max, spans))
+    uniform = bytearray(w*h)
+    for i in range(w):
+        low, high = lows[i::w], highs[i::w]
+        uniform[i::w] = bytes(
+            min(low[max(j-margin, 0):j+margin+1]) ==
+            max(high[max(j-margin, 0):j+margin+1]) for j in range(h))
+    return uniform
+
+
+def raytrace_adaptive(scene, img, updatefn=None, threshold=.1, levels=2,
+                      pixel_filter=None):
+    """raytrace scene into img, supersampling only where there are edges
+
+    Each pixel is first traced with one ray through its center, as in
+    raytrace. A pixel whose color differs from a neighbor's by more than
+    threshold (in any of r, g, b, clamped to 1) or that shows a
+    different material is then resampled with four rays, one in each
+    quarter of the pixel, and any quarter that still differs from the
+    others is split again, down to levels subdivisions. The samples of a
+    pixel are averaged, weighted by the area they stand for times
+    pixel_filter(dx, dy) of their offset from the pixel center (a box
+    filter, the plain average, by default; see tent_filter). updatefn
+    (if given) is called as in raytrace.
+
+    Returns a Record of the pixels in the image, the pixels refined and
+    the rays traced (samples, not counting shadow rays).
+
+    >>> from ren3d.scenedef import Scene
+    >>> from ren3d.image import Image
+    >>> scene = Scene()
+    >>> scene.add(Sphere((0, 0, -5), 1, (1, 0, 0)))
+    >>> scene.add(Box((1, 1, -7), (2, 2, 2), (0, 0, 1)))
+    >>> traced, smooth = Image((32, 24)), Image((32, 24))
+    >>> raytrace(scene, traced)
+    >>> stats = raytrace_adaptive(scene, smooth)
+    >>> stats.pixels, 0 < stats.refined < stats.pixels // 4
+    (768, True)
+    >>> changed = sum(traced[i, j] != smooth[i, j]
+    ...               for i in range(32) for j in range(24))
+    >>> 0 < changed <= stats.refined
+    True
+    """
+    camera = scene.camera
+    w, h = img.size
+    camera.set_resolution(w, h)
+    if pixel_filter is None:
+        pixel_filter = box_filter
+    stats = Record(pixels=w*h, refined=0, samples=w*h)
+
+    def sample_row(j):
+        return [_sample(scene, camera.ij_ray(i, j)) for i in range(w)]
+
+    # first samples (color, material, quantized color) of rows j and
+    # j+1, and flags marking their pixels that differ from a neighbor
+    limit = threshold * 255
+    row, edges = sample_row(0), bytearray(w)
+    for j in range(h):
+        if j+1 < h:
+            below, below_edges = sample_row(j+1), bytearray(w)
+            for i in range(w):
+                if _differ(row[i], below[i], limit):
+                    edges[i] = below_edges[i] = 1
+        for i in range(w-1):
+            if _differ(row[i], row[i+1], limit):
+                edges[i] = edges[i+1] = 1
+        for i in range(w):
+            if edges[i]:
+                acc = [0.0, 0.0, 0.0, 0.0]
+                stats.samples += _refine(scene, camera, i, j, i, j, 1.0,
+                                         levels, limit, pixel_filter, acc)
+                stats.refined += 1
+                r, g, b, weight = acc
+                img[i, j] = RGB((r/weight, g/weight, b/weight)).quantize(255)
+            else:
+                img[i, j] = row[i][2]
+        if updatefn:
+            updatefn((0, j, w, j+1))
+        if j+1 < h:
+            row, edges = below, below_edges
+    return stats
+
+
+def box_filter(dx, dy):
+    """pixel filter weighing all samples of a pixel equally"""
+    return 1.0
+
+
+def tent_filter(dx, dy):
+    """pixel filter weighing samples less the farther they are (dx, dy)
+    from the pixel center, down to a quarter at its corners
+
+    >>> tent_filter(0.0, 0.0), tent_filter(.5, -.5)
+    (1.0, 0.25)
+    """
+    return (1 - abs(dx)) * (1 - abs(dy))
+
+
+def _sample(scene, ray):
+    # (color, material, quantized color) seen along ray; the material is
+    # None for the background
+    info = Record()
+    if scene.surface.intersect(ray, Interval(), info):
+        color = _shade(scene, ray, info)
+        return color, info.color, color.quantize(255)
+    color = scene.background
+    return color, None, color.quantize(255)
+
+
+def _differ(a, b, limit):
+    # do samples a and b show an edge: different materials, or colors
+    # more than limit (out of 255) apart?
+    if a[1] is not b[1]:
+        return True
+    p, q = a[2], b[2]
+    return (abs(p[0]-q[0]) > limit or abs(p[1]-q[1]) > limit or
+            abs(p[2]-q[2]) > limit)
+
+
+def _refine(scene, camera, i, j, x, y, size, levels, limit,
+            pixel_filter, acc):
+    # add the samples of the square of the given size centered at (x, y)
+    # within pixel (i, j) into acc (weighted r, g, b sums and the total
+    # weight); returns the number of rays traced
+    q = size/4
+    points = [(x-q, y-q), (x+q, y-q), (x-q, y+q), (x+q, y+q)]
+    samples = [_sample(scene, camera.ij_ray(px, py)) for px, py in points]
+    count = 4
+    area = (size/2)**2
+    for (px, py), s in zip(points, samples):
+        if levels > 1 and any(_differ(s, t, limit) for t in samples):
+            count += _refine(scene, camera, i, j, px, py, size/2,
+                             levels-1, limit, pixel_filter, acc)
+        else:
+            weight = area * pixel_filter(px-i, py-j)
+            r, g, b = s[0].values
+            acc[0] += weight*r
+            acc[1] += weight*g
+            acc[2] += weight*b
+            acc[3] += weight
+    return count
 
 
 def raycolor(scene, ray, interval):
@@ -30,27 +474,60 @@ def raycolor(scene, ray, interval):
     """
 
     info = Record()
-    lpos, lcol = scene.light
     if scene.surface.intersect(ray, interval, info):
-        color = scene.ambient.times(info.color.ambient)
-        if not shadow(scene, info.point, lpos):
-            lvec = (scene.camera.eye-info.point).normalized()
-            lambert = max(0, lvec.dot(info.normal))
-            color += info.color.diffuse.times(lcol) * lambert
-
-            v = -ray.dir.normalized()
-            h = (lvec + v).normalized()
-            specular = (max(0, h.dot(info.normal)))**info.color.exponent
-            color += info.color.specular.times(lcol) * specular
-        return scene.ambient + lambert * info.color
+        return _shade(scene, ray, info)
     else:
         return scene.background
 
+
+def _shade(scene, ray, info):
+    # color at the hit of ray recorded in info, lit by scene.light
+    lpos, lcol = scene.light
+    color = scene.ambient.times(info.color.ambient)
+    if not shadow(scene, info.point, lpos):
+        lvec = (lpos-info.point).normalized()
+        lambert = max(0, lvec.dot(info.normal))
+        color += info.color.diffuse.times(lcol) * lambert
+
+        v = -ray.dir.normalized()
+        h = (lvec + v).normalized()
+        specular = (max(0, h.dot(info.normal)))**info.color.exponent
+        color += info.color.specular.times(lcol) * specular
+    return color
+
 def shadow(scene, hitpt, light):
-    r_start = hitpt
-    r_dir = (light - hitpt)
-    r_inter = Interval(EPSILON, 1)
-    return scene.surface.intersect(Ray(r_start,r_dir), r_inter, Record()) 
+    """returns True iff something lies between hitpt and the light at
+    position light
+
+    This is an any-hit query (see Group.occluder). The primitive (or
+    mesh triangle) found to block the light is kept in scene.occluders
+    and tested first for the next shadow ray, since neighboring points
+    are usually shadowed by the same one.
+
+    >>> from ren3d.scenedef import Scene
+    >>> scene = Scene()
+    >>> scene.add(Sphere((0, 0, -5), 1, (1, 0, 0)))
+    >>> light = Point((0, 0, 0))
+    >>> shadow(scene, Point((0, 0, -10)), light)
+    True
+    >>> scene.occluders[light] is scene.surface.objects[0]
+    True
+    >>> shadow(scene, Point((0, 3, -10)), light)
+    False
+    """
+    ray = Ray(hitpt, light - hitpt)
+    interval = Interval(EPSILON, 1)
+    occluders = getattr(scene, "occluders", None)
+    if occluders is not None:
+        last = occluders.get(light)
+        if last is not None and last.occluder(ray, interval) is not None:
+            return True
+    blocker = scene.surface.occluder(ray, interval)
+    if blocker is None:
+        return False
+    if occluders is not None:
+        occluders[light] = blocker
+    return True
 
 
     
@@ -2,9 +2,20 @@
 #    Calculations on color values
 # by: John Zelle
 
+_new = object.__new__
+
+
+def _rgb(r, g, b):
+    # build an RGB from three floats without coercing them
+    c = _new(RGB)
+    c.values = (r, g, b)
+    return c
+
 
 class RGB:
 
+    __slots__ = ("values",)
+
     def __init__(self, rgb):
         """ representaiton of color using 3 floating point values
 
@@ -16,7 +27,8 @@ class RGB:
         (1.0, 0.0, 1.0)
         >>>
         """
-        self.values = tuple(float(i) for i in rgb)
+        r, g, b = rgb
+        self.values = (float(r), float(g), float(b))
 
     def __repr__(self):
         """
@@ -40,7 +52,9 @@ class RGB:
         >>> RGB((.5, .8, 1.1)).quantize(255)
         (128, 204, 255)
         """
-        return tuple(min(round(v*top), top) for v in self.values)
+        r, g, b = self.values
+        return (min(round(r*top), top), min(round(g*top), top),
+                min(round(b*top), top))
 
     def __mul__(self, i):
         """ return a new RGB that is scaled by i
@@ -48,7 +62,8 @@ class RGB:
         >>> .25*RGB((.8, .5, .4))
         RGB((0.2, 0.125, 0.1))
         """
-        return RGB(i*v for v in self)
+        r, g, b = self.values
+        return _rgb(i*r, i*g, i*b)
 
     def __rmul__(self, i):
         """ return a new RGB that is scaled by i
@@ -56,13 +71,28 @@ class RGB:
         >>> RGB((.8, .5, .4))*(.25)
         RGB((0.2, 0.125, 0.1))
         """
-        return RGB(i*v for v in self)
+        r, g, b = self.values
+        return _rgb(i*r, i*g, i*b)
 
     def __add__(self, other):
-        return RGB(a+b for a, b in zip(self, other))
+        """ componentwise sum with another RGB (or any 3-sequence)
+
+        >>> RGB((.5, .25, 0)) + RGB((.25, .25, 1))
+        RGB((0.75, 0.5, 1.0))
+        """
+        r, g, b = self.values
+        r2, g2, b2 = other.values if type(other) is RGB else other
+        return _rgb(r+r2, g+g2, b+b2)
     
     def times(self,other):
-        return RGB(a*b for a,b in zip(self.values, other.values))
+        """ componentwise product with another RGB
+
+        >>> RGB((.5, .5, 1)).times(RGB((.5, 1, .25)))
+        RGB((0.25, 0.5, 0.25))
+        """
+        r, g, b = self.values
+        r2, g2, b2 = other.values
+        return _rgb(r*r2, g*g2, b*b2)
 
 
 if __name__ == "__main__":
@@ -21,11 +21,19 @@ class Scene(object):
         self.background = (0, 0, 0)
         self.ambient = 0.0
         self.light = (Point([0, 0, 0]), RGB((1,1,1)))
+        # last object found to shadow each light (by light position),
+        # tried first for the next shadow ray (see render_ray.shadow)
+        self.occluders = {}
 
 
     def add(self, surface):
         self.surface.add(surface)
 
+    @property
+    def objects(self):
+        # the renderers in render_oo refer to the scene's surface by this name
+        return self.surface
+
     @property
     def background(self):
         return self._background
@@ -1,45 +1,327 @@
 # texture.py
 # by yohannes dawit
 # simple implementation of texture mapping.
+#
+# Texture images are decoded once into float rgb arrays with a pyramid of
+# successively halved copies (mipmap levels). Lookups filter bilinearly
+# within a level and, given the size of the area a pixel covers on the
+# surface (its footprint), blend the two nearest levels (trilinear), so
+# distant surfaces are averaged instead of aliased.
+#
+# Decoded images are shared through a TextureCache keyed by file, so
+# scenes that reuse a texture (or a process rendering many scenes) load
+# it once, and the cache keeps them within a memory budget. A texture
+# only loads its image when first looked up, so making one (e.g. while
+# importing a scene module) costs next to nothing.
 
-from math import atan2, tau, pi, asin
+import os
+from array import array
+from collections import OrderedDict
+from copy import copy
+from math import atan2, tau, pi, asin, log2
 
 from ren3d.image import Image
+from ren3d.models import Record
 from ren3d.rgb import RGB
 
-def _pixrbg(img, loc):
-    return RGB([v/255 for v in img[loc]])
 
 def lerp(v, low0, high0, low1, high1):
     return low1 + (v-low0)*(high1-low1)/(high0-low0)
 
-class Boxtexture:
 
-    def __init__(self, imagefile):
-        self.image = Image(imagefile)
+class MipMap:
+    """Filtered lookups in an image, stored as float rgb values (0 to 1).
 
-    def __call__(self, uvn):
+    levels[0] is the image itself and each further level halves the
+    previous one (averaging 2x2 blocks) down to a single texel. A level
+    is (width, height, values) with the rows of values bottom first, so
+    texture coordinates (s, t) run from (0, 0) at the lower left to
+    (1, 1) at the upper right, as pixel positions do in an Image.
+    With wrap, s wraps around instead of clamping at the edges.
+
+    >>> img = Image((2, 2))
+    >>> img[0, 0] = img[1, 1] = (255, 255, 255)
+    >>> mm = MipMap(img)
+    >>> [level[:2] for level in mm.levels]
+    [(2, 2), (1, 1)]
+    >>> mm.sample(.25, .25), mm.sample(.5, .5)
+    (RGB((1.0, 1.0, 1.0)), RGB((0.5, 0.5, 0.5)))
+    >>> mm.sample(.25, .25, lod=1), mm.sample(.25, .25, lod=.5)
+    (RGB((0.5, 0.5, 0.5)), RGB((0.75, 0.75, 0.75)))
+    """
+
+    def __init__(self, image, wrap=False):
+        self.wrap = wrap
+        w, h = image.size
+        pix = image.view_bytes()
+        scale = 1/255
+        values = array("f")
+        for y in range(h):
+            row = 3*w*(h-y-1)
+            values.extend([v*scale for v in pix[row:row+3*w]])
+        self.levels = [(w, h, values)]
+        while w > 1 or h > 1:
+            w, h, values = self._halve(w, h, values)
+            self.levels.append((w, h, values))
+
+    @staticmethod
+    def _halve(w, h, values):
+        # next level: each texel averages a 2x2 block of the level given
+        # (the last row or column of an odd sized level is dropped)
+        nw, nh = max(w//2, 1), max(h//2, 1)
+        dx = 3 if w > 1 else 0
+        dy = 3*w if h > 1 else 0
+        out = array("f")
+        for y in range(nh):
+            row = 6*w*y if h > 1 else 0
+            for x in range(nw):
+                a = row + (6*x if w > 1 else 0)
+                b, c, d = a + dx, a + dy, a + dx + dy
+                out.extend(((values[a] + values[b] + values[c] + values[d])*.25,
+                            (values[a+1] + values[b+1] + values[c+1]
+                             + values[d+1])*.25,
+                            (values[a+2] + values[b+2] + values[c+2]
+                             + values[d+2])*.25))
+        return nw, nh, out
+
+    @property
+    def size(self):
+        return self.levels[0][:2]
+
+    def nbytes(self):
+        """memory used by the levels, in bytes"""
+        return sum(v.itemsize * len(v) for w, h, v in self.levels)
+
+    def lod(self, ds, dt=None):
+        """level of detail for a footprint ds wide and dt (default ds)
+        high in texture coordinates, where 1 spans the whole image
+
+        >>> mm = MipMap(Image((64, 32)))
+        >>> mm.lod(1/64), mm.lod(1/16), mm.lod(1/64, 1/8)
+        (0.0, 2.0, 2.0)
+        """
+        w, h = self.levels[0][:2]
+        texels = max(ds*w, (ds if dt is None else dt)*h)
+        return log2(texels) if texels > 1 else 0.0
+
+    def sample(self, s, t, lod=0.0):
+        """RGB at texture coordinates (s, t), filtered bilinearly in level
+        lod; a fractional lod blends the two levels around it
+        """
+        levels = self.levels
+        if lod <= 0.0:
+            r, g, b = self._bilinear(levels[0], s, t)
+        elif lod >= len(levels) - 1:
+            r, g, b = self._bilinear(levels[-1], s, t)
+        else:
+            n = int(lod)
+            f = lod - n
+            r0, g0, b0 = self._bilinear(levels[n], s, t)
+            r1, g1, b1 = self._bilinear(levels[n+1], s, t)
+            r, g, b = r0 + f*(r1-r0), g0 + f*(g1-g0), b0 + f*(b1-b0)
+        return RGB((r, g, b))
+
+    def _bilinear(self, level, s, t):
+        # (r, g, b) interpolated between the four texel centers around
+        # (s, t) in level
+        w, h, v = level
+        x = s*w - .5
+        y = t*h - .5
+        if self.wrap:
+            x %= w
+            if x >= w:      # rounding of a tiny negative x
+                x = 0.0
+        elif x < 0.0:
+            x = 0.0
+        elif x > w - 1:
+            x = w - 1.0
+        if y < 0.0:
+            y = 0.0
+        elif y > h - 1:
+            y = h - 1.0
+        x0, y0 = int(x), int(y)
+        fx, fy = x - x0, y - y0
+        # offsets to the texels right of and above (x0, y0)
+        if x0 < w - 1:
+            dx = 3
+        else:
+            dx = 3 - 3*w if self.wrap else 0
+        dy = 3*w if y0 < h - 1 else 0
+        a = 3*(y0*w + x0)
+        b, c = a + dx, a + dy
+        d = c + dx
+        lo = v[a] + fx*(v[b] - v[a])
+        r = lo + fy*(v[c] + fx*(v[d] - v[c]) - lo)
+        lo = v[a+1] + fx*(v[b+1] - v[a+1])
+        g = lo + fy*(v[c+1] + fx*(v[d+1] - v[c+1]) - lo)
+        lo = v[a+2] + fx*(v[b+2] - v[a+2])
+        return r, g, lo + fy*(v[c+2] + fx*(v[d+2] - v[c+2]) - lo)
+
+
+class TextureCache:
+    """Decoded textures (MipMaps) by file, least recently used first.
+
+    get(path) loads a file only if it is not cached or has changed since
+    (by modification time). Textures are evicted, oldest use first, to
+    keep the cached total within budget bytes; one larger than the whole
+    budget is returned but not kept. Evicted textures stay alive for as
+    long as something still uses them, they are just loaded again the
+    next time they are asked for.
+
+    >>> import tempfile
+    >>> tmp = tempfile.TemporaryDirectory()
+    >>> names = [os.path.join(tmp.name, c + ".ppm") for c in "abc"]
+    >>> for name in names:
+    ...     Image((8, 8)).save(name)
+    >>> MipMap(Image(names[0])).nbytes()
+    1020
+    >>> cache = TextureCache(budget=2500)
+    >>> a = cache.get(names[0])
+    >>> cache.get(names[0]) is a
+    True
+    >>> b, c = cache.get(names[1]), cache.get(names[2])
+    >>> r = cache.report()
+    >>> r.hits, r.misses, r.evictions, r.entries, r.nbytes
+    (1, 3, 1, 2, 2040)
+    >>> cache.get(names[0]) is a     # evicted, so loaded again
+    False
+    >>> cache.budget = 1500
+    >>> len(cache), cache.evictions
+    (1, 3)
+    >>> tmp.cleanup()
+    """
+
+    def __init__(self, budget=64*2**20):
+        # path -> (mtime, mipmap, nbytes), most recently used last
+        self._entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self.budget = budget
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def budget(self):
+        return self._budget
+
+    @budget.setter
+    def budget(self, nbytes):
+        # lowering the budget evicts at once
+        self._budget = nbytes
+        self._evict()
+
+    def get(self, path, wrap=False):
+        """MipMap for the image file path; with wrap, one that wraps
+        around horizontally (sharing the cached levels)
+        """
+        key = os.path.abspath(path)
+        mtime = os.stat(key).st_mtime_ns
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == mtime:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            mipmap = entry[1]
+        else:
+            self.misses += 1
+            if entry is not None:
+                self._remove(key)
+            mipmap = MipMap(Image(path, lazy=True))
+            nbytes = mipmap.nbytes()
+            if nbytes <= self.budget:
+                self._entries[key] = (mtime, mipmap, nbytes)
+                self.nbytes += nbytes
+                self._evict()
+        if wrap:
+            mipmap = copy(mipmap)
+            mipmap.wrap = True
+        return mipmap
+
+    def clear(self):
+        """drop all cached textures (the counters are kept)"""
+        self._entries.clear()
+        self.nbytes = 0
+
+    def _remove(self, key):
+        self.nbytes -= self._entries.pop(key)[2]
+
+    def _evict(self):
+        # drop least recently used textures until within budget
+        while self.nbytes > self.budget:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def report(self):
+        """Returns a Record with the counters hits, misses and evictions
+        and the current entries, nbytes and budget
+        """
+        return Record(hits=self.hits, misses=self.misses,
+                      evictions=self.evictions, entries=len(self),
+                      nbytes=self.nbytes, budget=self.budget)
+
+
+# cache shared by the textures of a process
+texture_cache = TextureCache()
+
+
+class _ImageTexture:
+    # texture from an image file, loaded through a TextureCache (by
+    # default texture_cache) when first looked up. WRAP tells whether
+    # it wraps around horizontally.
+
+    WRAP = False
+
+    def __init__(self, imagefile, cache=None):
+        self.imagefile = imagefile
+        self.cache = cache
+
+    def __getattr__(self, name):
+        # the mipmap is loaded on first use and then found as an
+        # ordinary attribute, so later lookups pay nothing for this
+        if name != "mipmap":
+            raise AttributeError(name)
+        cache = texture_cache if self.cache is None else self.cache
+        self.mipmap = cache.get(self.imagefile, self.WRAP)
+        return self.mipmap
+
+    @property
+    def size(self):
+        return self.mipmap.size
+
+
+class Boxtexture(_ImageTexture):
+    """Texture for a box: uvn is a point on the box scaled to [-1, 1] on
+    each axis and the face is the axis of the largest coordinate. The
+    footprint (if given) is the width a pixel covers, in the same units.
+    """
+
+    def __call__(self, uvn, footprint=0.0):
         # skip largest value (mapping to nearest plane)
-        coords = list(uvn)
-        coords.remove(max(uvn, key=abs))
-        u, v = coords
-        w, h = self.image.size
-        pixel = round((w-1) * (u+1)/2), round((h-1) * (v+1)/2)
-        # print("texture pixel", uvn, u, v, pixel)
-        return _pixrbg(self.image, pixel)
+        x, y, z = uvn
+        ax, ay, az = abs(x), abs(y), abs(z)
+        if ax >= ay and ax >= az:
+            u, v = y, z
+        elif ay >= az:
+            u, v = x, z
+        else:
+            u, v = x, y
+        mipmap = self.mipmap
+        lod = mipmap.lod(footprint/2) if footprint else 0.0
+        return mipmap.sample((u+1)/2, (v+1)/2, lod)
 
 
-class Spheretexture:
+class Spheretexture(_ImageTexture):
+    """Texture wrapped around a sphere: uvn is a point on the unit sphere
+    and the footprint (if given) is the width a pixel covers on it.
+    """
 
-    def __init__(self, imagefile):
-        self.image = Image(imagefile)
+    WRAP = True
 
-    def __call__(self, uvn):
+    def __call__(self, uvn, footprint=0.0):
         theta,phi = self._theta_phi(uvn)
-        w,h = self.image.size
-        x = lerp(phi, 0, tau, 0, w-1)
-        y = lerp(theta, -pi/2, pi/2, 0, h-1)
-        return _pixrbg(self.image, (round(x), round(y)))
+        mipmap = self.mipmap
+        lod = mipmap.lod(footprint/tau, footprint/pi) if footprint else 0.0
+        return mipmap.sample(phi/tau, (theta + pi/2)/pi, lod)
 
     def _theta_phi(self,uvn):
         x,y,z = uvn
@@ -49,3 +331,7 @@ class Spheretexture:
             phi += tau
         return theta, phi
 
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -1,11 +1,12 @@
 # run_rt.py -- raytrace a scene with a simple progress indicator
-#    usage: pypy run_rt.py scene0 320 240
+#    usage: pypy run_rt.py scene0 320 240 [workers]
+#    giving a number of workers renders tiles in parallel processes
 
 import sys
 import time
 
 from ren3d.scenedef import load_scene
-from ren3d.render_ray import raytrace
+from ren3d.render_ray import raytrace, raytrace_parallel
 from ren3d.image import Image
 
 
@@ -15,8 +16,10 @@ class Progress:
         self.size = size
         self.count = 0
 
-    def show(self):
-        self.count += 1
+    def show(self, rect):
+        # called with each finished row (or tile) rectangle
+        x0, y0, x1, y1 = rect
+        self.count += (x1-x0) * (y1-y0)
         print(str(round(self.count/self.size*100, 1))+"%", end="\r")
         sys.stdout.flush()
 
@@ -26,7 +29,10 @@ def main():
     w, h = int(sys.argv[2]), int(sys.argv[3])
     img = Image((w, h))
     t1 = time.time()
-    raytrace(scene, img, Progress(h).show)
+    if len(sys.argv) > 4:
+        raytrace_parallel(scene, img, Progress(w*h).show, int(sys.argv[4]))
+    else:
+        raytrace(scene, img, Progress(w*h).show)
     t2 = time.time()
     img.save("images/{}-rt-{:d}-{:d}.ppm".format(scenename, w, h))
     img.show()
@@ -8,6 +8,7 @@ from random import random
 camera.set_perspective(60, 4/3, 50)
 scene.background = (1, 1, 1)
 scene.ambient = (.2, .2, .2)
+scene.surface.accel = "auto"
 
 scene.add(Sphere(pos=(0, 300, -1200), radius=200, color=(.8, 0, 0)))
 scene.add(Sphere(pos=(-80, 150, -1200), radius=200, color=(0, .8, 0)))